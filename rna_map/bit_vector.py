@@ -1,35 +1,93 @@
+import io
 import os
-import re
-import pickle
+import itertools
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
-from typing import Dict, List
+from typing import List, Optional
 from pathlib import Path
 
+import numba
+import numpy as np
 import pandas as pd
 from tabulate import tabulate
 
 from rna_map import settings
 from rna_map.mutation_histogram import (
+    BitVectorEncoding,
     MutationHistogram,
     get_dataframe,
+    get_mut_histos_from_npz_file,
+    get_mut_histos_from_pickle_file,
     plot_modified_bases,
     plot_mutation_histogram,
     plot_population_avg,
     plot_read_coverage,
     write_mut_histos_to_json_file,
+    write_mut_histos_to_npz_file,
     write_mut_histos_to_pickle_file,
 )
 from rna_map.logger import get_logger
-from rna_map.sam import AlignedRead, SingleSamIterator, PairedSamIterator
-from rna_map.util import parse_phred_qscore_file, fasta_to_dict
+from rna_map.sam import (
+    AlignedRead,
+    SingleSamIterator,
+    PairedSamIterator,
+    PysamIterator,
+    pysam_exists,
+    read_sam_line_chunks,
+)
+from rna_map.util import parse_phred_qscore_lut, fasta_to_dict
 
 log = get_logger("BIT_VECTOR")
 
+# cigar operations stored as ascii codes
+CIGAR_MATCH = ord("M")
+CIGAR_DEL = ord("D")
+CIGAR_INS = ord("I")
+CIGAR_SOFT_CLIP = ord("S")
+SUPPORTED_CIGAR_OPS = (CIGAR_MATCH, CIGAR_DEL, CIGAR_INS, CIGAR_SOFT_CLIP)
 
-@dataclass(frozen=True, order=True)
+# number of sam lines handed to a worker process at a time, must be even so
+# paired reads stay together
+CHUNK_SIZE = 10000
+# bytes of bit vector lines held in memory before writing to disk
+WRITE_BUFFER_SIZE = 1 << 20
+# reads or read pairs decoded and handed to the numba kernel at a time
+BATCH_SIZE = 1000
+
+# codes stored at each position of a bit vector, mutations are the codes
+# BV_A to BV_T, BV_N is used for any other base in the read
+BV_NONE = 0
+BV_NOMUT = 1
+BV_DEL = 2
+BV_AMBIG = 3
+BV_MISS = 4
+BV_A = 5
+BV_C = 6
+BV_G = 7
+BV_T = 8
+BV_N = 9
+BV_BASE_CODES = {"A": BV_A, "C": BV_C, "G": BV_G, "T": BV_T}
+# the codes above as passed to MutationHistogram.record_bit_vectors
+BV_HISTO_ENCODING = BitVectorEncoding.from_codes(BV_BASE_CODES, BV_DEL, BV_AMBIG)
+
+
+@dataclass
 class BitVector:
+    """
+    bit vector of one read or read pair. data is indexed by reference position
+    and stores one of the BV_ codes for each bit, BV_NONE marks positions with
+    no data.
+    n_mutations is the number of positions that are mutated bases. reads that
+    fail the cheap checks in BitVectorIterator have no data and a
+    reject_reason
+    """
+
     reads: List[AlignedRead]
-    data: Dict
+    data: Optional[np.ndarray]
+    n_mutations: int = 0
+    reject_reason: Optional[str] = None
 
 
 @dataclass(frozen=True, order=True)
@@ -40,28 +98,123 @@ class BitVectorSymbols:
     del_bit: str = "1"
 
 
+# character written to bit vector files for each code
+BV_CHARS = np.frombuffer(
+    (
+        "."
+        + BitVectorSymbols.nomut_bit
+        + BitVectorSymbols.del_bit
+        + BitVectorSymbols.ambig_info
+        + BitVectorSymbols.miss_info
+        + "ACGTN"
+    ).encode(),
+    dtype=np.uint8,
+)
+# code of each read base indexed by ascii value
+BV_READ_BASE_CODES = np.full(256, BV_N, dtype=np.uint8)
+for _base, _code in BV_BASE_CODES.items():
+    BV_READ_BASE_CODES[ord(_base)] = _code
+
+
+def is_mutation(bits):
+    """
+    returns a mask of the positions of a bit vector that are mutated bases
+    """
+    return (bits >= BV_A) & (bits <= BV_T)
+
+
+def _merge_bits(bit_1, bit_2):
+    """
+    merges the bits of two mates at the same position, returns the merged bit
+    and whether the pair could not be merged
+    """
+    # only one read covers the position or both agree
+    if bit_1 == BV_NONE or bit_1 == bit_2:
+        return bit_2, False
+    if bit_2 == BV_NONE:
+        return bit_1, False
+    # one of the bits is not mutated take that
+    if bit_1 == BV_NOMUT or bit_2 == BV_NOMUT:
+        return BV_NOMUT, False
+    # one of the bits is ambig or missing take the other
+    for code in [BV_AMBIG, BV_MISS]:
+        if bit_1 == code:
+            return bit_2, False
+        if bit_2 == code:
+            return bit_1, False
+    # both bits are mutations and different or mutation on one side and
+    # deletion on the other side set to "?"
+    is_base_1 = BV_A <= bit_1 <= BV_T
+    is_base_2 = BV_A <= bit_2 <= BV_T
+    if (is_base_1 or bit_1 == BV_DEL) and (is_base_2 or bit_2 == BV_DEL):
+        return BV_AMBIG, False
+    return bit_1, True
+
+
+# merged bit and unmergeable pairs indexed by (bit_1 << 4) | bit_2
+BV_MERGE_LUT = np.zeros(256, dtype=np.uint8)
+BV_MERGE_WARN = np.zeros(256, dtype=bool)
+for _bit_1 in range(16):
+    for _bit_2 in range(16):
+        _index = (_bit_1 << 4) | _bit_2
+        BV_MERGE_LUT[_index], BV_MERGE_WARN[_index] = _merge_bits(_bit_1, _bit_2)
+
+
 class BitVectorFileWriter(object):
     def __init__(self, path, name, sequence, data_type, start, end):
         self.start = start
         self.end = end
         self.sequence = sequence
-        self.f = open(path / Path(name + "_bitvectors.txt"), "w")
-        self.f.write(f"@ref\t{name}\t{sequence}\t{data_type}\n")
-        self.f.write(f"@coordinates:\t{start},{end}:{len(sequence)}\n")
-        self.f.write("Query_name\tBit_vector\tN_Mutations\n")
+        self.f = open(path / Path(name + "_bitvectors.txt"), "wb")
+        self._buf = bytearray()
+        self._buf += (
+            f"@ref\t{name}\t{sequence}\t{data_type}\n"
+            f"@coordinates:\t{start},{end}:{len(sequence)}\n"
+            "Query_name\tBit_vector\tN_Mutations\n"
+        ).encode()
 
-    def write_bit_vector(self, q_name, bit_vector):
-        n_mutations = 0
-        bit_string = ""
-        for pos in range(self.start, self.end + 1):
-            if pos not in bit_vector:
-                bit_string += "."
-            else:
-                read_bit = bit_vector[pos]
-                if read_bit.isalpha():
-                    n_mutations += 1
-                bit_string += read_bit
-        self.f.write(f"{q_name}\t{bit_string}\t{n_mutations}\n")
+    def write_bit_vector(self, q_name, bit_vector, n_mutations):
+        bits = bit_vector[self.start : self.end + 1]
+        self._buf += q_name.encode()
+        self._buf += b"\t"
+        self._buf += BV_CHARS[bits].tobytes()
+        self._buf += b"\t%d\n" % n_mutations
+        if len(self._buf) > WRITE_BUFFER_SIZE:
+            self.flush()
+
+    def write_lines(self, lines):
+        """
+        appends already formatted bit vector lines
+        :param lines: bytes of one or more lines
+        """
+        self._buf += lines
+        if len(self._buf) > WRITE_BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.f.write(self._buf)
+        self._buf.clear()
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+
+class BitVectorBufferWriter(BitVectorFileWriter):
+    """
+    collects bit vector lines in memory instead of a file, used by worker
+    processes so the main process can append them to the real file
+    """
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.f = io.BytesIO()
+        self._buf = bytearray()
+
+    def getvalue(self):
+        self.flush()
+        return self.f.getvalue()
 
 
 class BitVectorFileReader(object):
@@ -72,172 +225,184 @@ class BitVectorFileReader(object):
 class BitVectorIterator(object):
     """
     A class to generate bit vectors from a SAM files. Does mininal checking
-    to the bitvector is acceptable.
+    to the bitvector is acceptable. sam_path can also be a list of sam lines
+    with the header removed. Reads below map_score_cutoff or shorter than
+    percent_length_cutoff of the reference are returned without building a
+    bit vector.
     """
 
     def __init__(
-        self, sam_path, ref_seqs, paired, qscore_cutoff=25, num_of_surbases=10
+        self,
+        sam_path,
+        ref_seqs,
+        paired,
+        qscore_cutoff=25,
+        num_of_surbases=10,
+        map_score_cutoff=0,
+        percent_length_cutoff=None,
     ):
-        if paired:
-            self.__sam_iterator = PairedSamIterator(sam_path, ref_seqs)
-        else:
-            self.__sam_iterator = SingleSamIterator(sam_path, ref_seqs)
+        self.__sam_iterator = self._get_sam_iterator(sam_path, ref_seqs, paired)
         self.count = 0
         self.rejected = 0
         self.__ref_seqs = ref_seqs
         self.__paired = paired
-        self.__cigar_pattern = re.compile(r"(\d+)([A-Z]{1})")
-        self.__phred_qscores = parse_phred_qscore_file(
+        self.__phred_lut = parse_phred_qscore_lut(
             settings.get_py_path() / "resources" / "phred_ascii.txt"
         )
+        # reference sequences concatenated for the numba kernel, reads refer
+        # to their reference by index
+        self.__ref_ids = {name: i for i, name in enumerate(ref_seqs)}
+        self.__ref_concat, self.__ref_offsets = _concat_ascii(list(ref_seqs.values()))
+        self.__pending = deque()
         # params
-        self.__bases = ["A", "C", "G", "T"]
         self.__qscore_cutoff = qscore_cutoff
         self.__num_of_surbases = num_of_surbases
-        self.__bts = BitVectorSymbols()
+        self.__map_score_cutoff = map_score_cutoff
+        self.__percent_length_cutoff = percent_length_cutoff
+
+    def _get_sam_iterator(self, sam_path, ref_seqs, paired):
+        if paired:
+            return PairedSamIterator(sam_path, ref_seqs)
+        return SingleSamIterator(sam_path, ref_seqs)
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        self.count += 1
-        reads = next(self.__sam_iterator)
-        for read in reads:
-            if read.rname not in self.__ref_seqs:
-                raise ValueError(
-                    f"read {read.qname} aligned to {read.rname} which is not in "
-                    "the reference fasta"
-                )
-        if self.__paired:
-            data = self.__get_bit_vector_paired(reads[0], reads[1])
-        else:
-            data = self.__get_bit_vector_single(reads[0])
-        return BitVector(reads, data)
-
-    def __get_bit_vector_single(self, read):
-        ref_seq = self.__ref_seqs[read.rname]
-        bit_vector = self.__convert_read_to_bit_vector(read, ref_seq)
-        return bit_vector
+        if not self.__pending:
+            self.__read_batch()
+        if not self.__pending:
+            raise StopIteration
+        return self.__pending.popleft()
 
-    def __convert_read_to_bit_vector(self, read: AlignedRead, ref_seq: str):
-        bitvector = {}
-        read_seq = read.seq
-        q_scores = read.qual
-        i = read.pos  # Pos in the ref sequence
-        j = 0  # Pos in the read sequence
-        cigar_ops = self._parse_cigar(read.cigar)
-        op_index = 0
-        while op_index < len(cigar_ops):
-            op = cigar_ops[op_index]
-            desc, length = op[1], int(op[0])
-            if desc == "M":  # Match or mismatch
-                for k in range(length):
-                    if self.__phred_qscores[q_scores[j]] > self.__qscore_cutoff:
-                        if read_seq[j] != ref_seq[i - 1]:
-                            bitvector[i] = read_seq[j]
-                        else:
-                            bitvector[i] = self.__bts.nomut_bit
-                    else:
-                        bitvector[i] = self.__bts.ambig_info
-                    i += 1
-                    j += 1
-            elif desc == "D":  # Deletion
-                for k in range(length - 1):
-                    bitvector[i] = self.__bts.ambig_info
-                    i += 1
-                is_ambig = self.__calc_ambig_reads(ref_seq, i, length)
-                if is_ambig:
-                    bitvector[i] = self.__bts.ambig_info
-                else:
-                    bitvector[i] = self.__bts.del_bit
-                i += 1
-            elif desc == "I":  # Insertion
-                j += length  # Update read index
-            elif desc == "S":  # soft clipping
-                j += length  # Update read index
-                if op_index == len(cigar_ops) - 1:  # Soft clipped at the end
-                    for k in range(length):
-                        bitvector[i] = self.__bts.miss_info
-                        i += 1
+    def __read_batch(self):
+        """
+        reads the next BATCH_SIZE reads or read pairs from the sam file and
+        builds all their bit vectors with one call to the numba kernel
+        """
+        groups = []
+        reads_to_build = []
+        for reads in itertools.islice(self.__sam_iterator, BATCH_SIZE):
+            self.count += 1
+            for read in reads:
+                if read.rname not in self.__ref_seqs:
+                    raise ValueError(
+                        f"read {read.qname} aligned to {read.rname} which is not "
+                        "in the reference fasta"
+                    )
+            reject_reason = self.__get_reject_reason(reads)
+            if reject_reason is not None:
+                self.rejected += 1
             else:
-                log.warn("unknown cigar op encounters: {}".format(desc))
-                return {}
-            op_index += 1
-        return bitvector
-
-    def __get_bit_vector_paired(self, read_1, read_2):
-        ref_seq = self.__ref_seqs[read_1.rname]
-        bit_vector_1 = self.__convert_read_to_bit_vector(read_1, ref_seq)
-        bit_vector_2 = self.__convert_read_to_bit_vector(read_2, ref_seq)
-        bit_vector = self.__merge_paired_bit_vectors(bit_vector_1, bit_vector_2)
-        return bit_vector
-
-    def _parse_cigar(self, cigar_string):
-        return re.findall(self.__cigar_pattern, cigar_string)
-
-    def __calc_ambig_reads(self, ref_seq, i, length):
-        orig_del_start = i - length + 1
-        orig_sur_start = orig_del_start - self.__num_of_surbases
-        orig_sur_end = i + self.__num_of_surbases
-        orig_sur_seq = (
-            ref_seq[orig_sur_start - 1 : orig_del_start - 1] + ref_seq[i:orig_sur_end]
-        )
-        for new_del_end in range(i - length, i + length + 1):  # Alt del end points
-            if new_del_end == i:  # Orig end point
+                reads_to_build.extend(reads)
+            groups.append((reads, reject_reason))
+        if not groups:
+            return
+        bit_vectors, n_mutations = self.__build_bit_vectors(reads_to_build)
+        row = 0
+        for reads, reject_reason in groups:
+            if reject_reason is not None:
+                self.__pending.append(BitVector(reads, None, 0, reject_reason))
                 continue
-            new_del_start = new_del_end - length + 1
-            sur_seq = (
-                ref_seq[orig_sur_start - 1 : new_del_start - 1]
-                + ref_seq[new_del_end:orig_sur_end]
+            ref_len = len(self.__ref_seqs[reads[0].rname])
+            data = bit_vectors[row, : ref_len + 1]
+            n_muts = n_mutations[row]
+            if self.__paired:
+                data = self.__merge_paired_bit_vectors(
+                    data, bit_vectors[row + 1, : ref_len + 1]
+                )
+                # mates overlap so the merged mutations have to be counted again
+                n_muts = np.count_nonzero(is_mutation(data))
+            row += len(reads)
+            self.__pending.append(BitVector(reads, data, int(n_muts)))
+
+    def __build_bit_vectors(self, reads: List[AlignedRead]):
+        """
+        decodes reads into flat arrays and builds one bit vector row per read,
+        returns the bit vector matrix and the number of mutations in each row
+        """
+        # each string field is encoded once per batch rather than once per read
+        read_seqs, read_offsets = _concat_ascii([read.seq for read in reads])
+        quals, qual_offsets = _concat_ascii([read.qual for read in reads])
+        if not np.array_equal(read_offsets, qual_offsets):
+            read = reads[np.flatnonzero(read_offsets != qual_offsets)[0] - 1]
+            raise ValueError(
+                f"read {read.qname} has {len(read.qual)} quality scores for "
+                f"{len(read.seq)} bases"
             )
-            if sur_seq == orig_sur_seq:
-                return True
-        return False
+        cigar_lengths, cigar_ops, cigar_offsets = _parse_cigars(
+            *_concat_ascii([read.cigar for read in reads])
+        )
+        bit_vectors, n_mutations = _build_bitvectors(
+            read_seqs,
+            read_offsets,
+            quals,
+            np.array([read.pos for read in reads], dtype=np.int64),
+            np.array([self.__ref_ids[read.rname] for read in reads], dtype=np.int64),
+            self.__ref_concat,
+            self.__ref_offsets,
+            cigar_lengths,
+            cigar_ops,
+            cigar_offsets,
+            self.__phred_lut,
+            self.__qscore_cutoff,
+            self.__num_of_surbases,
+        )
+        for row in np.flatnonzero(n_mutations < 0):
+            for op in cigar_ops[cigar_offsets[row] : cigar_offsets[row + 1]]:
+                if op not in SUPPORTED_CIGAR_OPS:
+                    log.warn("unknown cigar op encounters: {}".format(chr(op)))
+                    break
+            else:
+                read = reads[row]
+                log.warn(
+                    f"cigar {read.cigar} of read {read.qname} does not match its "
+                    f"{len(read.seq)} bases"
+                )
+            n_mutations[row] = 0
+        return bit_vectors, n_mutations
+
+    def __get_reject_reason(self, reads):
+        for read in reads:
+            if read.mapq < self.__map_score_cutoff:
+                return "low_mapq"
+        if self.__percent_length_cutoff is None:
+            return None
+        ref_len = len(self.__ref_seqs[reads[0].rname])
+        for read in reads:
+            if len(read.seq) / ref_len < self.__percent_length_cutoff:
+                return "short_read"
+        return None
 
     def __merge_paired_bit_vectors(self, bit_vector_1, bit_vector_2):
-        bit_vector = dict(bit_vector_1)
-        for pos, bit in bit_vector_2.items():
-            if pos not in bit_vector:  # unique to bit_vector_2
-                bit_vector[pos] = bit
-            elif bit != bit_vector[pos]:  # keys in both and bits not the same
-                bits = set([bit_vector_1[pos], bit])
-                if (
-                    self.__bts.nomut_bit in bits
-                ):  # one of the bits is not mutated take that
-                    bit_vector[pos] = self.__bts.nomut_bit
-                # one of the bits is ambig take the other
-                elif self.__bts.ambig_info in bits:
-                    other_bit = list(bits - set(self.__bts.ambig_info))[0]
-                    bit_vector[pos] = other_bit
-                # one of the bits is missing take the other
-                elif self.__bts.miss_info in bits:
-                    other_bit = list(bits - set(self.__bts.miss_info))[0]
-                    bit_vector[pos] = other_bit
-                # both bits are mutations and different set to "?"
-                elif bit_vector_1[pos] in self.__bases and bit in self.__bases:
-                    bit_vector[pos] = self.__bts.ambig_info
-                # mutation on one side and insertion on the other side set to "?"
-                elif (
-                    bit_vector_1[pos] == self.__bts.del_bit
-                    and bit in self.__bases
-                    or bit_vector_1[pos] in self.__bases
-                    and bit == self.__bts.del_bit
-                ):
-                    bit_vector[pos] = self.__bts.ambig_info
-                else:
-                    log.warn(
-                        "unable to merge bit_vectors with bits: {} {}".format(
-                            bit_vector_1[pos], bit
-                        )
+        index = (bit_vector_1.astype(np.intp) << 4) | bit_vector_2
+        bit_vector = BV_MERGE_LUT[index]
+        if BV_MERGE_WARN[index].any():
+            for pos in np.flatnonzero(BV_MERGE_WARN[index]):
+                log.warn(
+                    "unable to merge bit_vectors with bits: {} {}".format(
+                        chr(BV_CHARS[bit_vector_1[pos]]),
+                        chr(BV_CHARS[bit_vector_2[pos]]),
                     )
+                )
         return bit_vector
 
 
-class BitVectorGenerator(object):
-    def __init__(self):
-        self.__bases = ["A", "C", "G", "T"]
-        self.__bts = BitVectorSymbols()
+class PysamBitVectorIterator(BitVectorIterator):
+    """
+    BitVectorIterator that reads the sam or bam file with pysam instead of
+    parsing lines in python, requires pysam to be installed
+    """
 
+    def __init__(self, sam_path, ref_seqs, paired, threads=1, **kwargs):
+        self.__threads = threads
+        super().__init__(sam_path, ref_seqs, paired, **kwargs)
+
+    def _get_sam_iterator(self, sam_path, ref_seqs, paired):
+        return PysamIterator(sam_path, paired, self.__threads)
+
+
+class BitVectorGenerator(object):
     def setup(self, params):
         self.__params = params
         self.__out_dir = Path(params["dirs"]["output"]) / "BitVector_Files"
@@ -246,12 +411,11 @@ class BitVectorGenerator(object):
 
     def run(self, sam_path, fasta, paired, csv_file):
         log.info("starting bitvector generation")
-        self.__ref_seqs = fasta_to_dict(fasta)
-        self.__bit_vec_iterator = BitVectorIterator(sam_path, self.__ref_seqs, paired)
+        self._setup_bit_vector_params(fasta_to_dict(fasta), paired)
+        self.__sam_path = sam_path
+        self.__bit_vec_iterator = self.__get_bit_vector_iterator(sam_path)
         self.__mut_histos = {}
-        self.__map_score_cutoff = self.__params["bit_vector"]["map_score_cutoff"]
         self.__csv_file = csv_file
-        self.__summary_only = self.__params["bit_vector"]["summary_output_only"]
         self.__rejected_out = open(self.__out_dir / "rejected_bvs.csv", "w")
         self.__rejected_out.write("qname,rname,reason,read1,read2,bitvector\n")
         # setup parameters about generating bit vectors
@@ -260,6 +424,48 @@ class BitVectorGenerator(object):
         self.__get_skip_summary()
         self.__write_summary_csv()
 
+    def _setup_bit_vector_params(self, ref_seqs, paired):
+        self.__ref_seqs = ref_seqs
+        self.__paired = paired
+        # these are checked for every read so they are looked up once
+        bv_params = self.__params["bit_vector"]
+        self.__summary_only = bv_params["summary_output_only"]
+        self.__stricter_constraints = self.__params["stricter_bv_constraints"]
+        self.__mutation_count_cutoff = bv_params["stricter_constraints"][
+            "mutation_count_cutoff"
+        ]
+        self.__min_mut_distance = bv_params["stricter_constraints"]["min_mut_distance"]
+
+    def __get_bit_vector_iterator(self, sam_path):
+        bv_params = self.__params["bit_vector"]
+        percent_length_cutoff = None
+        if self.__params["stricter_bv_constraints"]:
+            percent_length_cutoff = bv_params["stricter_constraints"][
+                "percent_length_cutoff"
+            ]
+        kwargs = {
+            "qscore_cutoff": bv_params["qscore_cutoff"],
+            "num_of_surbases": bv_params["num_of_surbases"],
+            "map_score_cutoff": bv_params["map_score_cutoff"],
+            "percent_length_cutoff": percent_length_cutoff,
+        }
+        # building AlignedRead objects costs more than splitting text lines so
+        # pysam is only used for files the python parser cannot read, worker
+        # processes always get lists of sam lines
+        if (
+            pysam_exists
+            and not isinstance(sam_path, list)
+            and Path(sam_path).suffix in [".bam", ".cram"]
+        ):
+            return PysamBitVectorIterator(
+                sam_path,
+                self.__ref_seqs,
+                self.__paired,
+                threads=bv_params["nthreads"],
+                **kwargs,
+            )
+        return BitVectorIterator(sam_path, self.__ref_seqs, self.__paired, **kwargs)
+
     def __write_summary_csv(self):
         cols = [
             "name",
@@ -289,10 +495,10 @@ class BitVectorGenerator(object):
         for mut_histo in self.__mut_histos.values():
             row = [mut_histo.name]
             for col in cols:
-                try:
-                    row.append(mut_histo.skips[col] / mut_histo.num_reads * 100)
-                except ZeroDivisionError:
+                if mut_histo.num_reads == 0:
                     row.append(0)
+                else:
+                    row.append(mut_histo.skips[col] / mut_histo.num_reads * 100)
             data.append(row)
         df = pd.DataFrame(data, columns=["name"] + cols)
         log.info(
@@ -305,6 +511,11 @@ class BitVectorGenerator(object):
         """
         Generate plots for each mutation histogram
         """
+        if self.__params["bit_vector"]["no_plots"]:
+            return
+        include_plotlyjs = True
+        if self.__params["bit_vector"]["plotly_js_cdn"]:
+            include_plotlyjs = "cdn"
         for _, mh in self.__mut_histos.items():
             fname = f"{self.__out_dir}/{mh.name}_{mh.start}_{mh.end}_"
             if not self.__summary_only:
@@ -314,36 +525,50 @@ class BitVectorGenerator(object):
                     mh.name,
                     f"{fname}pop_avg.html",
                     plot_sequence=self.__params["bit_vector"]["plot_sequence"],
+                    include_plotlyjs=include_plotlyjs,
                 )
             # TODO add generate other plots arg?
             if self.__params["restore_org_behavior"]:
                 plot_modified_bases(
-                    mh.get_nuc_coords(), mh.mod_bases, f"{fname}mutations.html"
+                    mh.get_nuc_coords(),
+                    mh.mod_bases,
+                    f"{fname}mutations.html",
+                    include_plotlyjs,
                 )
                 plot_mutation_histogram(
                     mh.get_nuc_coords(),
                     mh.num_of_mutations,
                     f"{fname}mutation_histogram.html",
+                    include_plotlyjs,
                 )
                 plot_read_coverage(
                     mh.get_nuc_coords(),
                     mh.get_read_coverage(),
                     f"{fname}read_coverage.html",
+                    include_plotlyjs,
                 )
 
     def __generate_all_bit_vectors(self):
+        npz_file = self.__out_dir / "mutation_histos.npz"
         pickle_file = self.__out_dir / "mutation_histos.p"
-        if os.path.isfile(pickle_file) and not self.__params["overwrite"]:
+        if not self.__params["overwrite"] and (
+            os.path.isfile(npz_file) or os.path.isfile(pickle_file)
+        ):
             log.info(
                 "SKIPPING bit vector generation, it has run already! specify"
                 " -overwrite "
                 + "to rerun"
             )
-            with open(pickle_file, "rb") as handle:
-                self._mut_histos = pickle.load(handle)
+            # runs from older versions only have the pickle file
+            if os.path.isfile(npz_file):
+                self.__mut_histos = get_mut_histos_from_npz_file(npz_file)
+            else:
+                self.__mut_histos = get_mut_histos_from_pickle_file(pickle_file)
             return
 
         self._bit_vector_writers = {}
+        self.__histo_batches = {}
+        self.__n_histo_queued = 0
         for ref_name, seq in self.__ref_seqs.items():
             self.__mut_histos[ref_name] = MutationHistogram(
                 ref_name, seq, "DMS", 1, len(seq)
@@ -352,115 +577,149 @@ class BitVectorGenerator(object):
                 self._bit_vector_writers[ref_name] = BitVectorFileWriter(
                     self.__out_dir, ref_name, seq, "DMS", 1, len(seq)
                 )
+        nthreads = self.__params["bit_vector"]["nthreads"]
+        if nthreads > 1:
+            self.__generate_bit_vectors_in_parallel(nthreads)
+        else:
+            for bit_vector in self.__bit_vec_iterator:
+                self.__record_bit_vector(bit_vector)
+            self.__flush_histo_batches()
+        for writer in self._bit_vector_writers.values():
+            writer.close()
+        self.__rejected_out.close()
+        # structures are assigned after so partial histograms from workers
+        # merge cleanly
         if str(self.__csv_file) != ".":
             df = pd.read_csv(self.__csv_file)
-            for i, row in df.iterrows():
-                if row["name"] in self.__mut_histos:
-                    self.__mut_histos[row["name"]].structure = row["structure"]
-        for bit_vector in self.__bit_vec_iterator:
-            self.__record_bit_vector(bit_vector)
-        # pickle mutational histograms
+            for name, structure in df[["name", "structure"]].itertuples(
+                index=False, name=None
+            ):
+                mh = self.__mut_histos.get(name)
+                if mh is not None:
+                    mh.structure = structure
+        # save mutational histograms
         json_file = os.path.join(self.__out_dir, "mutation_histos.json")
-        write_mut_histos_to_pickle_file(self.__mut_histos, pickle_file)
+        write_mut_histos_to_npz_file(self.__mut_histos, npz_file)
+        if self.__params["bit_vector"]["write_pickle"]:
+            write_mut_histos_to_pickle_file(self.__mut_histos, pickle_file)
         write_mut_histos_to_json_file(self.__mut_histos, json_file)
 
+    def __generate_bit_vectors_in_parallel(self, nthreads):
+        """
+        hands chunks of sam lines to worker processes and merges the partial
+        results back in file order
+        """
+        log.info(f"generating bit vectors with {nthreads} processes")
+        chunks = read_sam_line_chunks(self.__sam_path, self.__ref_seqs, CHUNK_SIZE)
+        # numba's thread pool does not survive a fork so workers are spawned
+        with ProcessPoolExecutor(
+            max_workers=nthreads,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_chunk_worker,
+            initargs=(self.__params, self.__ref_seqs, self.__paired),
+        ) as executor:
+            results = _map_in_order(executor, _process_chunk, chunks, nthreads * 2)
+            for mut_histos, bit_vector_lines, rejected_lines in results:
+                for ref_name, mh in mut_histos.items():
+                    self.__mut_histos[ref_name].merge(mh)
+                for ref_name, lines in bit_vector_lines.items():
+                    self._bit_vector_writers[ref_name].write_lines(lines)
+                self.__rejected_out.write(rejected_lines)
+
+    def _generate_chunk_bit_vectors(self, lines):
+        """
+        generates bit vectors for a chunk of sam lines inside a worker process
+        :param lines: sam lines with the header removed
+        :return: partial mutation histograms, bit vector lines per reference
+        and rejected bit vector lines
+        """
+        self.__mut_histos = {}
+        self._bit_vector_writers = {}
+        self.__histo_batches = {}
+        self.__n_histo_queued = 0
+        ref_names = {line.split(maxsplit=3)[2] for line in lines}
+        for ref_name in ref_names & self.__ref_seqs.keys():
+            seq = self.__ref_seqs[ref_name]
+            self.__mut_histos[ref_name] = MutationHistogram(
+                ref_name, seq, "DMS", 1, len(seq)
+            )
+            if not self.__summary_only:
+                self._bit_vector_writers[ref_name] = BitVectorBufferWriter(1, len(seq))
+        self.__rejected_out = io.StringIO()
+        for bit_vector in self.__get_bit_vector_iterator(lines):
+            self.__record_bit_vector(bit_vector)
+        self.__flush_histo_batches()
+        bit_vector_lines = {
+            ref_name: writer.getvalue()
+            for ref_name, writer in self._bit_vector_writers.items()
+        }
+        return self.__mut_histos, bit_vector_lines, self.__rejected_out.getvalue()
+
     def __record_bit_vector(self, bit_vector):
-        mh = self.__mut_histos[bit_vector.reads[0].rname]
-        # if the reads do not meet the minimum mapping score, skip
-        for read in bit_vector.reads:
-            if read.mapq < self.__map_score_cutoff:
-                self.__write_rejected_bit_vector(mh, bit_vector, "low_mapq")
-                mh.record_skip("low_mapq")
-                return
+        read = bit_vector.reads[0]
+        mh = self.__mut_histos[read.rname]
+        # low mapping score and short reads are caught by the iterator
+        if bit_vector.reject_reason is not None:
+            self.__write_rejected_bit_vector(mh, bit_vector, bit_vector.reject_reason)
+            mh.record_skip(bit_vector.reject_reason)
+            return
         # experimental features
         # must turn --stricter-bv-constraints to use these
-        if self.__are_reads_to_short(mh, bit_vector):
-            return
         if self.__too_many_mutations(mh, bit_vector):
             return
         if self.__muts_too_close(mh, bit_vector):
             return
-        self.__update_mut_histo(mh, bit_vector.data)
-        if not self.__params["bit_vector"]["summary_output_only"]:
-            self._bit_vector_writers[bit_vector.reads[0].rname].write_bit_vector(
-                bit_vector.reads[0].qname, bit_vector.data
+        self.__add_to_histo_batch(mh, bit_vector)
+        if not self.__summary_only:
+            self._bit_vector_writers[read.rname].write_bit_vector(
+                read.qname, bit_vector.data, bit_vector.n_mutations
             )
 
-    def __update_mut_histo(self, mh: MutationHistogram, bit_vector):
-        mh.num_reads += 1
-        mh.num_aligned += 1
-        total_muts = 0
-        for pos in mh.get_nuc_coords():
-            if pos not in bit_vector:
-                continue
-            read_bit = bit_vector[pos]
-            if read_bit != self.__bts.ambig_info:
-                mh.cov_bases[pos] += 1
-            if read_bit in self.__bases:
-                total_muts += 1
-                mh.mod_bases[read_bit][pos] += 1
-                mh.mut_bases[pos] += 1
-            elif read_bit == self.__bts.del_bit:
-                mh.del_bases[pos] += 1
-            mh.info_bases[pos] += 1
-        mh.num_of_mutations[total_muts] += 1
+    def __add_to_histo_batch(self, mh: MutationHistogram, bit_vector):
+        """
+        queues a bit vector for its mutation histogram, histograms are updated
+        BATCH_SIZE bit vectors at a time
+        """
+        batch = self.__histo_batches.setdefault(mh.name, ([], []))
+        batch[0].append(bit_vector.data)
+        batch[1].append(bit_vector.n_mutations)
+        self.__n_histo_queued += 1
+        # queued bit vectors are views into the iterator's batch arrays, all
+        # references are flushed together so no batch array is kept alive by a
+        # reference that rarely gets reads
+        if self.__n_histo_queued >= BATCH_SIZE:
+            self.__flush_histo_batches()
 
-    # bit vector constraints ###################################################
+    def __record_histo_batch(self, ref_name):
+        bit_vectors, n_mutations = self.__histo_batches.pop(ref_name)
+        self.__mut_histos[ref_name].record_bit_vectors(
+            np.stack(bit_vectors), n_mutations, BV_HISTO_ENCODING
+        )
 
-    def __are_reads_to_short(self, mh, bit_vector) -> bool:
-        if not self.__params["stricter_bv_constraints"]:
-            return False
-        cutoff = self.__params["bit_vector"]["stricter_constraints"][
-            "percent_length_cutoff"
-        ]
-        ref_seq = self.__ref_seqs[bit_vector.reads[0].rname]
-        for read in bit_vector.reads:
-            per = len(read.seq) / len(ref_seq)
-            if per < cutoff:
-                self.__write_rejected_bit_vector(mh, bit_vector, "short_read")
-                mh.record_skip("short_read")
-                return True
-        return False
+    def __flush_histo_batches(self):
+        for ref_name in list(self.__histo_batches):
+            self.__record_histo_batch(ref_name)
+        self.__n_histo_queued = 0
+
+    # bit vector constraints ###################################################
 
     def __too_many_mutations(self, mh, bit_vector):
-        if not self.__params["stricter_bv_constraints"]:
+        if not self.__stricter_constraints:
             return False
-        cutoff = self.__params["bit_vector"]["stricter_constraints"][
-            "mutation_count_cutoff"
-        ]
-        muts = 0
-        for pos in mh.get_nuc_coords():
-            if pos not in bit_vector.data:
-                continue
-            read_bit = bit_vector.data[pos]
-            if read_bit in self.__bases:
-                muts += 1
-        if muts > cutoff:
+        if bit_vector.n_mutations > self.__mutation_count_cutoff:
             self.__write_rejected_bit_vector(mh, bit_vector, "too_many_muts")
             mh.record_skip("too_many_muts")
             return True
         return False
 
     def __muts_too_close(self, mh, bit_vector):
-        if not self.__params["stricter_bv_constraints"]:
+        if not self.__stricter_constraints:
             return False
-        cutoff = self.__params["bit_vector"]["stricter_constraints"]["min_mut_distance"]
-        for pos in range(mh.start, mh.end + 1):
-            if pos not in bit_vector.data:
-                continue
-            read_bit = bit_vector.data[pos]
-            if read_bit in self.__bases:
-                for pos2 in range(pos - cutoff, pos + cutoff):
-                    if pos2 == pos:
-                        continue
-                    if pos2 not in bit_vector.data:
-                        continue
-                    if bit_vector.data[pos2] in self.__bases:
-                        self.__write_rejected_bit_vector(
-                            mh, bit_vector, "muts_too_close"
-                        )
-                        mh.record_skip("muts_too_close")
-                        return True
+        mut_pos = np.flatnonzero(is_mutation(bit_vector.data[mh.start : mh.end + 1]))
+        if np.any(np.diff(mut_pos) <= self.__min_mut_distance):
+            self.__write_rejected_bit_vector(mh, bit_vector, "muts_too_close")
+            mh.record_skip("muts_too_close")
+            return True
         return False
 
     def __write_rejected_bit_vector(self, mh, bit_vector, reason):
@@ -469,13 +728,307 @@ class BitVectorGenerator(object):
             read2_seq = bit_vector.reads[1].seq
         else:
             read2_seq = ""
-        bv_vec = []
-        for nuc in mh.get_nuc_coords():
-            if nuc in bit_vector.data:
-                bv_vec.append(bit_vector.data[nuc])
-            else:
-                bv_vec.append(".")
+        # reads rejected by the iterator never had a bit vector built
+        bit_string = ""
+        if bit_vector.data is not None:
+            bits = bit_vector.data[mh.start : mh.end + 1]
+            bit_string = BV_CHARS[bits].tobytes().decode()
         self.__rejected_out.write(
             f"{read1.qname},{read1.rname},{reason},{read1.seq},{read2_seq},"
-            f"{''.join(bv_vec)}\n"
+            f"{bit_string}\n"
         )
+
+
+# worker processes #############################################################
+
+_chunk_generator = None
+
+
+def _init_chunk_worker(params, ref_seqs, paired):
+    global _chunk_generator
+    # share the cores between the worker processes and the kernel threads
+    nthreads = params["bit_vector"]["nthreads"]
+    numba.set_num_threads(max(1, numba.config.NUMBA_NUM_THREADS // nthreads))
+    _chunk_generator = BitVectorGenerator()
+    _chunk_generator.setup(params)
+    _chunk_generator._setup_bit_vector_params(ref_seqs, paired)
+
+
+def _process_chunk(lines):
+    return _chunk_generator._generate_chunk_bit_vectors(lines)
+
+
+def _map_in_order(executor, func, iterable, max_pending):
+    """
+    like executor.map but only keeps max_pending tasks in flight so the whole
+    sam file is never held in memory
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+# bit vector kernel ############################################################
+
+_BYTES = numba.types.Array(numba.types.uint8, 1, "C")
+_INTS = numba.types.Array(numba.types.int32, 1, "C")
+_INT64S = numba.types.Array(numba.types.int64, 1, "C")
+
+
+@numba.njit(cache=True)
+def _calc_ambig_reads(ref_seq, i, length, num_of_surbases):
+    """
+    checks if a deletion ending at i could be placed elsewhere without
+    changing the surrounding sequence
+    """
+    # when the surrounding window fits in the reference any alternative
+    # placement requires a shift by one base to work, so only the bases
+    # flanking the deletion need to be compared
+    if (
+        num_of_surbases > 0
+        and i - length - num_of_surbases >= 0
+        and i + num_of_surbases <= len(ref_seq)
+    ):
+        return (
+            ref_seq[i - length] == ref_seq[i]
+            or ref_seq[i - length - 1] == ref_seq[i - 1]
+        )
+    orig_del_start = i - length + 1
+    orig_sur_start = orig_del_start - num_of_surbases
+    orig_sur_end = i + num_of_surbases
+    orig_sur_seq = np.concatenate(
+        (ref_seq[orig_sur_start - 1 : orig_del_start - 1], ref_seq[i:orig_sur_end])
+    )
+    for new_del_end in range(i - length, i + length + 1):  # Alt del end points
+        if new_del_end == i:  # Orig end point
+            continue
+        new_del_start = new_del_end - length + 1
+        sur_seq = np.concatenate(
+            (
+                ref_seq[orig_sur_start - 1 : new_del_start - 1],
+                ref_seq[new_del_end:orig_sur_end],
+            )
+        )
+        if len(sur_seq) == len(orig_sur_seq) and np.all(sur_seq == orig_sur_seq):
+            return True
+    return False
+
+
+@numba.njit(cache=True)
+def _fill_match(bitvector, read_seq, ref_seq, qual, i, j, length, phred_lut, cutoff):
+    """
+    writes a match or mismatch segment starting at ref position i and read
+    position j, returns the number of mutated bases in it
+    """
+    n_mutations = 0
+    # positions past the end of the reference are dropped
+    for k in range(min(length, len(bitvector) - i)):
+        if phred_lut[qual[j + k]] <= cutoff:
+            bitvector[i + k] = BV_AMBIG
+        elif read_seq[j + k] == ref_seq[i + k - 1]:
+            bitvector[i + k] = BV_NOMUT
+        else:
+            code = BV_READ_BASE_CODES[read_seq[j + k]]
+            bitvector[i + k] = code
+            if code <= BV_T:
+                n_mutations += 1
+    return n_mutations
+
+
+@numba.njit(cache=True)
+def _fill_bitvector(
+    bitvector,
+    read_seq,
+    ref_seq,
+    qual,
+    pos,
+    cigar_lengths,
+    cigar_ops,
+    phred_lut,
+    qscore_cutoff,
+    num_of_surbases,
+):
+    """
+    writes the bit vector of a single read into bitvector and returns the
+    number of mutated bases, or -1 if the cigar string contains an
+    unsupported operation or does not consume exactly the bases of the read
+    """
+    n_ops = len(cigar_ops)
+    # reads are packed end to end so a cigar string longer than its read
+    # would silently use the bases of the next read
+    read_len = 0
+    for op_index in range(n_ops):
+        op = cigar_ops[op_index]
+        if op == CIGAR_MATCH or op == CIGAR_INS or op == CIGAR_SOFT_CLIP:
+            read_len += cigar_lengths[op_index]
+    if read_len != len(read_seq):
+        return -1
+    # most reads align without indels or clipping
+    if n_ops == 1 and cigar_ops[0] == CIGAR_MATCH:
+        return _fill_match(
+            bitvector,
+            read_seq,
+            ref_seq,
+            qual,
+            pos,
+            0,
+            cigar_lengths[0],
+            phred_lut,
+            qscore_cutoff,
+        )
+    n_mutations = 0
+    i = pos  # Pos in the ref sequence
+    j = 0  # Pos in the read sequence
+    for op_index in range(n_ops):
+        length = cigar_lengths[op_index]
+        op = cigar_ops[op_index]
+        if op == CIGAR_MATCH:  # Match or mismatch
+            n_mutations += _fill_match(
+                bitvector,
+                read_seq,
+                ref_seq,
+                qual,
+                i,
+                j,
+                length,
+                phred_lut,
+                qscore_cutoff,
+            )
+            i += length
+            j += length
+        elif op == CIGAR_DEL:  # Deletion
+            bitvector[i : i + length - 1] = BV_AMBIG
+            i += length - 1
+            if i < len(bitvector):
+                if _calc_ambig_reads(ref_seq, i, length, num_of_surbases):
+                    bitvector[i] = BV_AMBIG
+                else:
+                    bitvector[i] = BV_DEL
+            i += 1
+        elif op == CIGAR_INS:  # Insertion
+            j += length  # Update read index
+        elif op == CIGAR_SOFT_CLIP:  # soft clipping
+            j += length  # Update read index
+            if op_index == n_ops - 1:  # Soft clipped at the end
+                # positions past the end of the reference are dropped
+                bitvector[i : i + length] = BV_MISS
+                i += length
+        else:
+            bitvector[:] = 0
+            return -1
+    return n_mutations
+
+
+@numba.njit(
+    numba.types.Tuple((numba.types.Array(numba.types.uint8, 2, "C"), _INT64S))(
+        _BYTES,
+        _INT64S,
+        _BYTES,
+        _INT64S,
+        _INT64S,
+        _BYTES,
+        _INT64S,
+        _INTS,
+        _INTS,
+        _INT64S,
+        _BYTES,
+        numba.types.int64,
+        numba.types.int64,
+    ),
+    parallel=True,
+    cache=True,
+)
+def _build_bitvectors(
+    read_seqs,
+    read_offsets,
+    quals,
+    positions,
+    ref_ids,
+    ref_seqs,
+    ref_offsets,
+    cigar_lengths,
+    cigar_ops,
+    cigar_offsets,
+    phred_lut,
+    qscore_cutoff,
+    num_of_surbases,
+):
+    """
+    builds the bit vectors of a batch of reads in parallel. reads, quality
+    scores, references and cigar operations are concatenated with offsets
+    marking where each entry starts. returns one row per read, sized to the
+    longest reference, and the number of mutated bases of each read
+    """
+    n_reads = len(positions)
+    max_ref_len = 0
+    for k in range(len(ref_offsets) - 1):
+        max_ref_len = max(max_ref_len, ref_offsets[k + 1] - ref_offsets[k])
+    bitvectors = np.zeros((n_reads, max_ref_len + 1), dtype=np.uint8)
+    n_mutations = np.zeros(n_reads, dtype=np.int64)
+    for r in numba.prange(n_reads):
+        ref_seq = ref_seqs[ref_offsets[ref_ids[r]] : ref_offsets[ref_ids[r] + 1]]
+        read_start = read_offsets[r]
+        read_end = read_offsets[r + 1]
+        cigar_start = cigar_offsets[r]
+        cigar_end = cigar_offsets[r + 1]
+        n_mutations[r] = _fill_bitvector(
+            bitvectors[r, : len(ref_seq) + 1],
+            read_seqs[read_start:read_end],
+            ref_seq,
+            quals[read_start:read_end],
+            positions[r],
+            cigar_lengths[cigar_start:cigar_end],
+            cigar_ops[cigar_start:cigar_end],
+            phred_lut,
+            qscore_cutoff,
+            num_of_surbases,
+        )
+    return bitvectors, n_mutations
+
+
+@numba.njit(
+    numba.types.Tuple((_INTS, _INTS, _INT64S))(_BYTES, _INT64S),
+    cache=True,
+)
+def _parse_cigars(cigars, offsets):
+    """
+    splits concatenated cigar strings into parallel arrays of lengths and ops,
+    each op is the ascii code of the operation. returns the lengths, the ops
+    and the offset of the first op of each cigar string
+    """
+    n_ops = 0
+    for c in cigars:
+        if c < 48 or c > 57:  # not a digit
+            n_ops += 1
+    lengths = np.empty(n_ops, dtype=np.int32)
+    ops = np.empty(n_ops, dtype=np.int32)
+    op_offsets = np.empty(len(offsets), dtype=np.int64)
+    op_index = 0
+    for r in range(len(offsets) - 1):
+        op_offsets[r] = op_index
+        length = 0
+        for c in cigars[offsets[r] : offsets[r + 1]]:
+            if 48 <= c <= 57:  # digit
+                length = length * 10 + c - 48
+            else:
+                lengths[op_index] = length
+                ops[op_index] = c
+                op_index += 1
+                length = 0
+    op_offsets[len(offsets) - 1] = op_index
+    return lengths, ops, op_offsets
+
+
+def _concat_ascii(strings):
+    """
+    concatenates ascii strings into one writable uint8 array, returns the
+    array and the offset of each string with the total length appended
+    """
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    np.cumsum([len(string) for string in strings], out=offsets[1:])
+    data = np.frombuffer(bytearray("".join(strings), "ascii"), dtype=np.uint8)
+    return data, offsets
@@ -142,6 +142,33 @@ def bit_vector_options():
                 " plots"
             ),
         ),
+        option(
+            "--nthreads",
+            type=int,
+            default=1,
+            help="number of processes used to generate bit vectors",
+        ),
+        option(
+            "--write-pickle",
+            is_flag=True,
+            help=(
+                "also write mutation histograms to the old mutation_histos.p pickle"
+                " file"
+            ),
+        ),
+        option(
+            "--no-plots",
+            is_flag=True,
+            help="do not generate html plots, only data and summary files",
+        ),
+        option(
+            "--plotly-js-cdn",
+            is_flag=True,
+            help=(
+                "load plotly.js from its cdn instead of embedding it in every plot"
+                " file, plots then need internet access to display"
+            ),
+        ),
         option(
             "--map-score-cutoff",
             type=int,
@@ -261,6 +288,22 @@ def parse_cli_args(params, args):
     if args["plot_sequence"]:
         log.info("plotting sequence/structure on bit vector plots")
         params["bit_vector"]["plot_sequence"] = args["plot_sequence"]
+    if args["nthreads"] != 1:
+        log.info(
+            "generating bit vectors with {value} processes".format(
+                value=args["nthreads"]
+            )
+        )
+        params["bit_vector"]["nthreads"] = args["nthreads"]
+    if args["write_pickle"]:
+        log.info("writing mutation histograms to a pickle file")
+        params["bit_vector"]["write_pickle"] = args["write_pickle"]
+    if args["no_plots"]:
+        log.info("not generating plots")
+        params["bit_vector"]["no_plots"] = args["no_plots"]
+    if args["plotly_js_cdn"]:
+        log.info("loading plotly.js from its cdn in plots")
+        params["bit_vector"]["plotly_js_cdn"] = args["plotly_js_cdn"]
     if args["map_score_cutoff"] != 15:
         log.info(
             "mapping score cutoff set to {value}".format(value=args["map_score_cutoff"])
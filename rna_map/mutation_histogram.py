@@ -1,14 +1,17 @@
 """
 tracking mutations
 """
-from typing import Dict, List
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
 import json
+import os
+import numba
 import numpy as np
 import pandas as pd
 import pickle
 from dataclasses import dataclass
 
-import plotly
 import plotly.graph_objs as go
 import plotly.io as pio
 
@@ -28,6 +31,26 @@ class Globals:
 
 globals = Globals()
 
+# orjson is optional, histogram json files are read and written with the
+# standard json module when it is not installed
+try:
+    import orjson
+
+    orjson_exists = True
+except ImportError:
+    orjson_exists = False
+
+# ijson is optional, when it is installed json files larger than
+# JSON_STREAM_SIZE bytes are parsed one histogram at a time
+try:
+    import ijson
+
+    ijson_exists = True
+except ImportError:
+    ijson_exists = False
+
+JSON_STREAM_SIZE = 256 * 1024 * 1024
+
 # TODO figure out why kaleido is not working in docker container
 try:
     pio.kaleido.scope.chromium_args += ("--single-process",)
@@ -36,7 +59,93 @@ except:
     pass
 
 
+@dataclass(frozen=True)
+class BitVectorEncoding:
+    """
+    codes of the bit vectors passed to MutationHistogram.record_bit_vectors.
+    base_rows holds the code of each row of mod_bases_arr and n_codes bounds
+    the codes that have to be counted, so each batch only indexes arrays
+    """
+
+    base_rows: np.ndarray
+    del_code: int
+    ambig_code: int
+    n_codes: int
+
+    @classmethod
+    def from_codes(cls, base_codes, del_code, ambig_code):
+        """
+        :param base_codes: code of each mutated base keyed by base
+        :param del_code: code of a deletion
+        :param ambig_code: code of an ambiguous position
+        """
+        base_rows = np.array(
+            [base_codes[base] for base in MutationHistogram._BASE_IDX], dtype=np.intp
+        )
+        n_codes = max(del_code, ambig_code, *base_codes.values()) + 1
+        return cls(base_rows, del_code, ambig_code, n_codes)
+
+
+class _ModBasesView(Mapping):
+    """
+    dict style access to the rows of MutationHistogram.mod_bases_arr
+    """
+
+    __slots__ = ("_arr",)
+
+    def __init__(self, mod_bases_arr):
+        self._arr = mod_bases_arr
+
+    def __getitem__(self, base):
+        return self._arr[MutationHistogram._BASE_IDX[base]]
+
+    def __setitem__(self, base, counts):
+        self._arr[MutationHistogram._BASE_IDX[base]] = counts
+
+    def __iter__(self):
+        return iter(MutationHistogram._BASE_IDX)
+
+    def __len__(self):
+        return len(MutationHistogram._BASE_IDX)
+
+
 class MutationHistogram(object):
+    __slots__ = (
+        "name",
+        "sequence",
+        "structure",
+        "data_type",
+        "num_reads",
+        "num_aligned",
+        "skips",
+        "num_of_mutations",
+        "mut_bases",
+        "info_bases",
+        "del_bases",
+        "ins_bases",
+        "cov_bases",
+        "mod_bases_arr",
+        "start",
+        "end",
+        "_ac_mask",
+        "_ac_count",
+        "_gu_count",
+        "_nuc_coords",
+        "_nuc_coords_range",
+    )
+    # row of each base in mod_bases_arr
+    _BASE_IDX = {"A": 0, "C": 1, "G": 2, "T": 3}
+    # arrays of int64 counts
+    _COUNT_FIELDS = (
+        "num_of_mutations",
+        "mut_bases",
+        "info_bases",
+        "del_bases",
+        "ins_bases",
+        "cov_bases",
+        "mod_bases_arr",
+    )
+
     def __init__(self, name, sequence, data_type, start=None, end=None):
         self.name = name
         self.sequence = sequence
@@ -50,24 +159,65 @@ class MutationHistogram(object):
             "too_many_muts": 0,
             "muts_too_close": 0,
         }
-        self.num_of_mutations = [0] * (len(sequence) + 1)
-        self.mut_bases = np.zeros(len(sequence) + 1)
-        self.info_bases = np.zeros(len(sequence) + 1)
-        self.del_bases = np.zeros(len(sequence) + 1)
-        self.ins_bases = np.zeros(len(sequence) + 1)
-        self.cov_bases = np.zeros(len(sequence) + 1)
-        self.mod_bases = {
-            "A": np.zeros(len(sequence) + 1),
-            "C": np.zeros(len(sequence) + 1),
-            "G": np.zeros(len(sequence) + 1),
-            "T": np.zeros(len(sequence) + 1),
-        }
+        self.num_of_mutations = np.zeros(len(sequence) + 1, dtype=np.int64)
+        self.mut_bases = np.zeros(len(sequence) + 1, dtype=np.int64)
+        self.info_bases = np.zeros(len(sequence) + 1, dtype=np.int64)
+        self.del_bases = np.zeros(len(sequence) + 1, dtype=np.int64)
+        self.ins_bases = np.zeros(len(sequence) + 1, dtype=np.int64)
+        self.cov_bases = np.zeros(len(sequence) + 1, dtype=np.int64)
+        self.mod_bases_arr = np.zeros(
+            (len(self._BASE_IDX), len(sequence) + 1), dtype=np.int64
+        )
         self.start = start
         self.end = end
         if self.start is None:
             self.start = 1
         if self.end is None:
             self.end = len(self.sequence)
+        self.__cache_sequence_info()
+        # filled by get_nuc_coords for the current start and end
+        self._nuc_coords = ()
+        self._nuc_coords_range = None
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state):
+        # older pickles store mod_bases as a dict of arrays and the counts as
+        # floats or lists
+        mod_bases = state.pop("mod_bases", None)
+        if mod_bases is not None:
+            state["mod_bases_arr"] = np.stack(
+                [mod_bases[base] for base in self._BASE_IDX]
+            )
+        for field in self._COUNT_FIELDS:
+            state[field] = np.asarray(state[field], dtype=np.int64)
+        state.setdefault("_nuc_coords", ())
+        state.setdefault("_nuc_coords_range", None)
+        for name in self.__slots__:
+            if name in state:
+                setattr(self, name, state[name])
+        if "_ac_count" not in state:
+            self.__cache_sequence_info()
+
+    def __cache_sequence_info(self):
+        """
+        caches which positions are A or C and the number of A/C and G/U bases
+        used by get_signal_to_noise
+        """
+        seq = self.sequence
+        seq_codes = np.frombuffer(seq.encode(), dtype=np.uint8)
+        self._ac_mask = (seq_codes == ord("A")) | (seq_codes == ord("C"))
+        self._ac_count = int(np.count_nonzero(self._ac_mask))
+        self._gu_count = seq.count("G") + seq.count("U") + seq.count("T")
+
+    @property
+    def mod_bases(self):
+        """
+        the number of times each base was found mutated at each position, keyed
+        by base
+        """
+        return _ModBasesView(self.mod_bases_arr)
 
     @classmethod
     def from_dict(cls, d):
@@ -78,16 +228,67 @@ class MutationHistogram(object):
         mh.num_reads = d["num_reads"]
         mh.num_aligned = d["num_aligned"]
         mh.skips = d["skips"]
-        mh.num_of_mutations = d["num_of_mutations"]
-        mh.mut_bases = np.array(d["mut_bases"])
-        mh.info_bases = np.array(d["info_bases"])
-        mh.del_bases = np.array(d["del_bases"])
-        mh.ins_bases = np.array(d["ins_bases"])
-        mh.cov_bases = np.array(d["cov_bases"])
-        mh.mod_bases["A"] = np.array(d["mod_bases"]["A"])
-        mh.mod_bases["C"] = np.array(d["mod_bases"]["C"])
-        mh.mod_bases["G"] = np.array(d["mod_bases"]["G"])
-        mh.mod_bases["T"] = np.array(d["mod_bases"]["T"])
+        mh.num_of_mutations = np.asarray(d["num_of_mutations"], dtype=np.int64)
+        mh.mut_bases = np.asarray(d["mut_bases"], dtype=np.int64)
+        mh.info_bases = np.asarray(d["info_bases"], dtype=np.int64)
+        mh.del_bases = np.asarray(d["del_bases"], dtype=np.int64)
+        mh.ins_bases = np.asarray(d["ins_bases"], dtype=np.int64)
+        mh.cov_bases = np.asarray(d["cov_bases"], dtype=np.int64)
+        mh.mod_bases_arr = np.array(
+            [d["mod_bases"][base] for base in cls._BASE_IDX], dtype=np.int64
+        )
+        return mh
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        """
+        Returns the per position counts as arrays keyed by field name
+        """
+        arrays = {
+            "num_of_mutations": self.num_of_mutations,
+            "mut_bases": self.mut_bases,
+            "info_bases": self.info_bases,
+            "del_bases": self.del_bases,
+            "ins_bases": self.ins_bases,
+            "cov_bases": self.cov_bases,
+        }
+        for base, counts in self.mod_bases.items():
+            arrays[f"mod_bases_{base}"] = counts
+        return arrays
+
+    def get_metadata(self):
+        """
+        Returns everything that is not stored in to_arrays
+        """
+        return {
+            "name": self.name,
+            "sequence": self.sequence,
+            "structure": self.structure,
+            "data_type": self.data_type,
+            "start": self.start,
+            "end": self.end,
+            "num_reads": self.num_reads,
+            "num_aligned": self.num_aligned,
+            "skips": self.skips,
+        }
+
+    @classmethod
+    def from_arrays(cls, metadata, arrays):
+        mh = cls(metadata["name"], metadata["sequence"], metadata["data_type"])
+        mh.structure = metadata["structure"]
+        mh.start = metadata["start"]
+        mh.end = metadata["end"]
+        mh.num_reads = metadata["num_reads"]
+        mh.num_aligned = metadata["num_aligned"]
+        mh.skips = metadata["skips"]
+        mh.num_of_mutations = arrays["num_of_mutations"].astype(np.int64)
+        mh.mut_bases = arrays["mut_bases"].astype(np.int64)
+        mh.info_bases = arrays["info_bases"].astype(np.int64)
+        mh.del_bases = arrays["del_bases"].astype(np.int64)
+        mh.ins_bases = arrays["ins_bases"].astype(np.int64)
+        mh.cov_bases = arrays["cov_bases"].astype(np.int64)
+        mh.mod_bases_arr = np.stack(
+            [arrays[f"mod_bases_{base}"] for base in cls._BASE_IDX]
+        ).astype(np.int64)
         return mh
 
     def get_dict(self):
@@ -101,17 +302,14 @@ class MutationHistogram(object):
             "num_reads": self.num_reads,
             "num_aligned": self.num_aligned,
             "skips": self.skips,
-            "num_of_mutations": self.num_of_mutations,
+            "num_of_mutations": self.num_of_mutations.tolist(),
             "mut_bases": self.mut_bases.tolist(),
             "info_bases": self.info_bases.tolist(),
             "del_bases": self.del_bases.tolist(),
             "ins_bases": self.ins_bases.tolist(),
             "cov_bases": self.cov_bases.tolist(),
             "mod_bases": {
-                "A": self.mod_bases["A"].tolist(),
-                "C": self.mod_bases["C"].tolist(),
-                "G": self.mod_bases["G"].tolist(),
-                "T": self.mod_bases["T"].tolist(),
+                base: counts.tolist() for base, counts in self.mod_bases.items()
             },
         }
 
@@ -136,14 +334,38 @@ class MutationHistogram(object):
         self.num_aligned += other.num_aligned
         for key in self.skips.keys():
             self.skips[key] += other.skips[key]
-        for ii in range(len(other.num_of_mutations)):
-            self.num_of_mutations[ii] += other.num_of_mutations[ii]
+        self.num_of_mutations += other.num_of_mutations
         self.mut_bases += other.mut_bases
+        self.del_bases += other.del_bases
         self.ins_bases += other.ins_bases
         self.cov_bases += other.cov_bases
         self.info_bases += other.info_bases
-        for key in self.mod_bases.keys():
-            self.mod_bases[key] += other.mod_bases[key]
+        self.mod_bases_arr += other.mod_bases_arr
+
+    def record_bit_vectors(
+        self, bit_vectors, n_mutations, encoding: BitVectorEncoding
+    ) -> None:
+        """
+        Adds a batch of bit vectors to the histogram
+        :param bit_vectors: 2D array with one bit vector per row indexed by
+        reference position, 0 marks positions without data
+        :param n_mutations: number of mutations in each bit vector
+        :param encoding: the codes used in the bit vectors
+        """
+        coords = slice(self.start, self.end + 1)
+        counts = _count_codes(bit_vectors[:, coords], encoding.n_codes)
+        self.num_reads += len(bit_vectors)
+        self.num_aligned += len(bit_vectors)
+        has_data = len(bit_vectors) - counts[0]
+        self.info_bases[coords] += has_data
+        self.cov_bases[coords] += has_data - counts[encoding.ambig_code]
+        mod_counts = counts[encoding.base_rows]
+        self.mod_bases_arr[:, coords] += mod_counts
+        self.mut_bases[coords] += mod_counts.sum(axis=0)
+        self.del_bases[coords] += counts[encoding.del_code]
+        self.num_of_mutations += np.bincount(
+            n_mutations, minlength=len(self.num_of_mutations)
+        )
 
     def record_skip(self, t):
         self.num_reads += 1
@@ -154,39 +376,37 @@ class MutationHistogram(object):
         """
         Returns normalized read coverage
         """
-        read_cov = []
-        for pos in self.get_nuc_coords():
-            try:
-                cov_frac = self.cov_bases[pos] / self.num_reads
-            except ZeroDivisionError:
-                cov_frac = 0.0
-            read_cov.append(cov_frac)
-        return read_cov
-
-    def get_nuc_coords(self) -> List[int]:
+        cov_bases = self.cov_bases[self.start : self.end + 1]
+        read_cov = np.divide(
+            cov_bases,
+            self.num_reads,
+            out=np.zeros(len(cov_bases)),
+            where=self.num_reads != 0,
+        )
+        return read_cov.tolist()
+
+    def get_nuc_coords(self) -> Tuple[int, ...]:
         """
-        Returns the nucleotide coordinates of the histogram
+        Returns the nucleotide coordinates of the histogram, they are only
+        rebuilt when start or end change
         """
-        return list(range(self.start, self.end + 1))
+        if self._nuc_coords_range != (self.start, self.end):
+            self._nuc_coords = tuple(range(self.start, self.end + 1))
+            self._nuc_coords_range = (self.start, self.end)
+        return self._nuc_coords
 
     def get_pop_avg(self, inc_del=False) -> List[float]:
         """
         Returns the population average of the histogram
         :param inc_del: if True, include deletions in the average
         """
-        pop_avg = []
-        for pos in self.get_nuc_coords():
-            try:
-                if inc_del:
-                    mut_frac = (
-                        self.del_bases[pos] + self.mut_bases[pos]
-                    ) / self.info_bases[pos]
-                else:
-                    mut_frac = self.mut_bases[pos] / self.info_bases[pos]
-            except:
-                mut_frac = 0.0
-            pop_avg.append(round(mut_frac, 5))
-        return pop_avg
+        coords = slice(self.start, self.end + 1)
+        muts = self.mut_bases[coords]
+        if inc_del:
+            muts = muts + self.del_bases[coords]
+        info = self.info_bases[coords]
+        pop_avg = np.divide(muts, info, out=np.zeros(len(muts)), where=info > 0)
+        return np.round(pop_avg, 5).tolist()
 
     def get_pop_avg_dataframe(self) -> pd.DataFrame:
         """
@@ -207,24 +427,20 @@ class MutationHistogram(object):
         return df
 
     def get_percent_mutations(self):
-        data = np.array(self.num_of_mutations[0:4] + [sum(self.num_of_mutations[5:])])
-        if self.num_aligned != 0:
-            data = [round(x, 2) for x in list((data / self.num_aligned) * 100)]
-        return data
+        if self.num_aligned == 0:
+            return [0.0] * 5
+        data = np.empty(5)
+        data[:4] = self.num_of_mutations[:4]
+        data[4] = self.num_of_mutations[5:].sum()
+        return np.round(data / self.num_aligned * 100, 2).tolist()
 
     def get_signal_to_noise(self):
-        seq = self.sequence
-        AC = 0
-        GU = 0
-        AC_count = seq.count("A") + seq.count("C")
-        GU_count = seq.count("G") + seq.count("U") + seq.count("T")
-        for pos in self.get_nuc_coords():
-            if seq[pos - 1] == "A" or seq[pos - 1] == "C":
-                AC += self.mut_bases[pos]
-            else:
-                GU += self.mut_bases[pos]
-        AC /= float(AC_count)
-        GU /= float(GU_count)
+        muts = self.mut_bases[self.start : self.end + 1]
+        ac_mask = self._ac_mask[self.start - 1 : self.end]
+        AC = muts[ac_mask].sum()
+        GU = muts[~ac_mask].sum()
+        AC /= float(self._ac_count)
+        GU /= float(self._gu_count)
         if GU == 0:
             return 0
         return round(float(AC / GU), 2)
@@ -238,16 +454,14 @@ def convert_dreem_mut_histos_to_mutation_histogram(mhs) -> Dict[str, MutationHis
         new_mh.num_reads = mh.num_reads
         new_mh.num_aligned = mh.num_aligned
         new_mh.skips = mh.skips
-        new_mh.num_of_mutations = mh.num_of_mutations
+        new_mh.num_of_mutations = np.asarray(mh.num_of_mutations, dtype=np.int64)
         new_mh.mut_bases = mh.mut_bases
         new_mh.info_bases = mh.info_bases
         new_mh.del_bases = mh.del_bases
         new_mh.ins_bases = mh.ins_bases
         new_mh.cov_bases = mh.cov_bases
-        new_mh.mod_bases["A"] = mh.mod_bases["A"]
-        new_mh.mod_bases["C"] = mh.mod_bases["C"]
-        new_mh.mod_bases["G"] = mh.mod_bases["G"]
-        new_mh.mod_bases["T"] = mh.mod_bases["T"]
+        for base in new_mh.mod_bases:
+            new_mh.mod_bases[base] = mh.mod_bases[base]
         new_mhs[name] = new_mh
     return new_mhs
 
@@ -260,8 +474,13 @@ def write_mut_histos_to_json_file(
     :param mut_histos: the list of mutation histograms
     :param fname: the name of the json file
     """
+    data = {k: v.get_dict() for k, v in mut_histos.items()}
+    if orjson_exists:
+        with open(fname, "wb") as f:
+            f.write(orjson.dumps(data))
+        return
     with open(fname, "w", encoding="utf8") as f:
-        json.dump({k: v.get_dict() for k, v in mut_histos.items()}, f)
+        json.dump(data, f)
 
 
 def write_mut_histos_to_pickle_file(
@@ -276,13 +495,41 @@ def write_mut_histos_to_pickle_file(
         pickle.dump(mut_histos, f)
 
 
+def write_mut_histos_to_npz_file(
+    mut_histos: Dict[str, MutationHistogram], fname: str
+) -> None:
+    """
+    Writes mutation histograms to a compressed numpy file. Arrays are stored
+    as <index>/<field> and everything else as json under metadata
+    :param mut_histos: the dictionary of mutation histograms
+    :param fname: the name of the npz file
+    """
+    arrays = {}
+    metadata = []
+    for i, mh in enumerate(mut_histos.values()):
+        metadata.append(mh.get_metadata())
+        for field, values in mh.to_arrays().items():
+            arrays[f"{i}/{field}"] = values
+    np.savez_compressed(fname, metadata=np.array(json.dumps(metadata)), **arrays)
+
+
 def get_mut_histos_from_json_file(fname: str) -> Dict[str, MutationHistogram]:
     """
     Returns a list of mutation histograms from a json file
     :param fname: the name of the json file
     """
-    with open(fname, "r") as f:
-        data = json.load(f)
+    if ijson_exists and os.path.getsize(fname) > JSON_STREAM_SIZE:
+        with open(fname, "rb") as f:
+            return {
+                k: MutationHistogram.from_dict(v)
+                for k, v in ijson.kvitems(f, "", use_float=True)
+            }
+    if orjson_exists:
+        with open(fname, "rb") as f:
+            data = orjson.loads(f.read())
+    else:
+        with open(fname, "r") as f:
+            data = json.load(f)
     return {k: MutationHistogram.from_dict(v) for k, v in data.items()}
 
 
@@ -296,105 +543,121 @@ def get_mut_histos_from_pickle_file(fname: str) -> Dict[str, MutationHistogram]:
     return data
 
 
+def get_mut_histos_from_npz_file(fname: str) -> Dict[str, MutationHistogram]:
+    """
+    Returns mutation histograms from a file written by
+    write_mut_histos_to_npz_file
+    :param fname: the name of the npz file
+    """
+    with np.load(fname) as data:
+        metadata = json.loads(str(data["metadata"]))
+        arrays = [{} for _ in metadata]
+        for key in data.files:
+            if key == "metadata":
+                continue
+            index, field = key.split("/", 1)
+            arrays[int(index)][field] = data[key]
+    return {
+        md["name"]: MutationHistogram.from_arrays(md, mh_arrays)
+        for md, mh_arrays in zip(metadata, arrays)
+    }
+
+
+def _get_aligned_percent(mut_histo: MutationHistogram) -> float:
+    if mut_histo.num_reads == 0:
+        return 0.0
+    return round(float(mut_histo.num_aligned) / float(mut_histo.num_reads) * 100, 2)
+
+
+# how each column of get_dataframe is computed from a histogram
+DATA_COLUMN_EXTRACTORS = {
+    "name": lambda mh: mh.name,
+    "sequence": lambda mh: mh.sequence,
+    "structure": lambda mh: mh.structure,
+    "num_reads": lambda mh: mh.num_reads,
+    "reads": lambda mh: mh.num_reads,
+    "num_aligned": lambda mh: mh.num_aligned,
+    "aligned": _get_aligned_percent,
+    "num_of_mutations": lambda mh: mh.num_of_mutations,
+    "no_mut": lambda mh: mh.get_percent_mutations()[0],
+    "1_mut": lambda mh: mh.get_percent_mutations()[1],
+    "2_mut": lambda mh: mh.get_percent_mutations()[2],
+    "3_mut": lambda mh: mh.get_percent_mutations()[3],
+    "3plus_mut": lambda mh: mh.get_percent_mutations()[4],
+    "percent_mutations": lambda mh: mh.get_percent_mutations(),
+    "signal_to_noise": lambda mh: mh.get_signal_to_noise(),
+    "sn": lambda mh: mh.get_signal_to_noise(),
+    "read_coverage": lambda mh: mh.get_read_coverage(),
+    "pop_avg": lambda mh: mh.get_pop_avg(),
+    "pop_avg_del": lambda mh: mh.get_pop_avg(inc_del=True),
+    "skips": lambda mh: mh.skips,
+    "mod_bases": lambda mh: dict(mh.mod_bases),
+    "mut_bases": lambda mh: mh.mut_bases,
+    "del_bases": lambda mh: mh.del_bases,
+    "cov_bases": lambda mh: mh.cov_bases,
+    "info_bases": lambda mh: mh.info_bases,
+}
+
+
 def get_dataframe(mut_histos: Dict[str, MutationHistogram], data_cols) -> pd.DataFrame:
     """
     Returns a dataframe of the mutation histograms
     :param mut_histos: a dictionary of mutation histograms
+    :param data_cols: the columns to include, see DATA_COLUMN_EXTRACTORS
     """
-    data = []
-    for _, mut_histo in mut_histos.items():
-        data_row = []
-        for dc in data_cols:
-            if dc == "name":
-                data_row.append(mut_histo.name)
-            elif dc == "sequence":
-                data_row.append(mut_histo.sequence)
-            elif dc == "structure":
-                data_row.append(mut_histo.structure)
-            elif dc == "num_reads" or dc == "reads":
-                data_row.append(mut_histo.num_reads)
-            elif dc == "num_aligned":
-                data_row.append(mut_histo.num_aligned)
-            elif dc == "aligned":
-                aligned = 0.0
-                try:
-                    aligned = round(
-                        float(mut_histo.num_aligned) / float(mut_histo.num_reads) * 100,
-                        2,
-                    )
-                except ZeroDivisionError:
-                    pass
-                data_row.append(aligned)
-            elif dc == "num_of_mutations":
-                data_row.append(mut_histo.num_of_mutations)
-            elif dc == "no_mut":
-                data_row.append(mut_histo.get_percent_mutations()[0])
-            elif dc == "1_mut":
-                data_row.append(mut_histo.get_percent_mutations()[1])
-            elif dc == "2_mut":
-                data_row.append(mut_histo.get_percent_mutations()[2])
-            elif dc == "3_mut":
-                data_row.append(mut_histo.get_percent_mutations()[3])
-            elif dc == "3plus_mut":
-                data_row.append(mut_histo.get_percent_mutations()[4])
-            elif dc == "percent_mutations":
-                data_row.append(mut_histo.get_percent_mutations())
-            elif dc == "signal_to_noise" or dc == "sn":
-                data_row.append(mut_histo.get_signal_to_noise())
-            elif dc == "read_coverage":
-                data_row.append(mut_histo.get_read_coverage())
-            elif dc == "pop_avg":
-                data_row.append(mut_histo.get_pop_avg())
-            elif dc == "pop_avg_del":
-                data_row.append(mut_histo.get_pop_avg(inc_del=True))
-            elif dc == "skips":
-                data_row.append(mut_histo.skips)
-            elif dc == "mod_bases":
-                data_row.append(mut_histo.mod_bases)
-            elif dc == "mut_bases":
-                data_row.append(mut_histo.mut_bases)
-            elif dc == "del_bases":
-                data_row.append(mut_histo.del_bases)
-            elif dc == "cov_bases":
-                data_row.append(mut_histo.cov_bases)
-            elif dc == "info_bases":
-                data_row.append(mut_histo.info_bases)
-            else:
-                raise ValueError("Invalid data column: {}".format(dc))
-        data.append(data_row)
-    return pd.DataFrame(data, columns=data_cols)
+    for dc in data_cols:
+        if dc not in DATA_COLUMN_EXTRACTORS:
+            raise ValueError("Invalid data column: {}".format(dc))
+    cols = {
+        dc: [DATA_COLUMN_EXTRACTORS[dc](mh) for mh in mut_histos.values()]
+        for dc in data_cols
+    }
+    return pd.DataFrame(cols, columns=data_cols)
 
 
 # plotting functions ###########################################################
 
 
+# bar color of each base indexed by ascii value
+_COLOR_LUT = np.full(256, "green", dtype=object)
+_COLOR_LUT[ord("A")] = "red"
+_COLOR_LUT[ord("C")] = "blue"
+_COLOR_LUT[ord("G")] = "orange"
+
+
 def colors_for_sequence(seq: str) -> List[str]:
     """
     Returns a list of colors to plot a sequence with a barplot
+    :param seq: the sequence as a string or any iterable of bases
     """
-    colors = []
-    for e in seq:
-        if e == "A":
-            colors.append("red")
-        elif e == "C":
-            colors.append("blue")
-        elif e == "G":
-            colors.append("orange")
-        else:
-            colors.append("green")
-    return colors
+    seq_codes = np.frombuffer("".join(seq).encode("ascii", "replace"), np.uint8)
+    return _COLOR_LUT[seq_codes].tolist()
 
 
 # plotly functions ############################################################
 
 
-def plot_read_coverage(nuc_pos, read_coverage, fname: str) -> None:
+def write_plot_html(fig, fname: str, include_plotlyjs=True) -> None:
+    """
+    Writes a plotly figure to a html file
+    :param fig: the figure to write
+    :param fname: the name of the file to save the plot to
+    :param include_plotlyjs: True embeds plotly.js in the file, "cdn" loads it
+    from the plotly cdn which keeps each file a few kB instead of several MB
+    """
+    fig.write_html(fname, include_plotlyjs=include_plotlyjs, auto_open=False)
+
+
+def plot_read_coverage(
+    nuc_pos, read_coverage, fname: str, include_plotlyjs=True
+) -> None:
     """
     Plots the read coverage of the input sequence
-    :param nuc_pos: a list of nucleotide positions generated by mh.get_nuc_coords()
+    :param nuc_pos: the nucleotide positions generated by mh.get_nuc_coords()
     :param read_coverage: the coverage by nucleotide of number of reads
      mh.get_read_coverage()
     :param fname: the name of the file to save the plot to
+    :param include_plotlyjs: see write_plot_html
     """
     cov_trace = go.Bar(x=nuc_pos, y=read_coverage)
     cov_layout = go.Layout(
@@ -403,19 +666,21 @@ def plot_read_coverage(nuc_pos, read_coverage, fname: str) -> None:
         yaxis=dict(title="Coverage fraction"),
     )
     cov_fig = go.Figure(data=[cov_trace], layout=cov_layout)
-    plotly.offline.plot(cov_fig, filename=fname, auto_open=False)
+    write_plot_html(cov_fig, fname, include_plotlyjs)
 
 
-def plot_modified_bases(nuc_pos, mod_bases, fname) -> None:
+def plot_modified_bases(nuc_pos, mod_bases, fname, include_plotlyjs=True) -> None:
     """
     Plots the modified bases of the input sequence
-    :param nuc_pos: a list of nucleotide positions generated by mh.get_nuc_coords()
+    :param nuc_pos: the nucleotide positions generated by mh.get_nuc_coords()
     :param mod_bases: the number of modified bases to each nucleotide
+    :param include_plotlyjs: see write_plot_html
     """
     modbases_data = []
     cmap = {"A": "red", "T": "green", "G": "orange", "C": "blue"}  # Color map
+    positions = np.asarray(nuc_pos)
     for base in cmap.keys():
-        y_list = [mod_bases[base][pos] for pos in nuc_pos]
+        y_list = np.asarray(mod_bases[base])[positions].tolist()
         trace = go.Bar(x=nuc_pos, y=y_list, name=base, marker_color=cmap[base])
         modbases_data.append(trace)
     modbases_layout = go.Layout(
@@ -425,10 +690,12 @@ def plot_modified_bases(nuc_pos, mod_bases, fname) -> None:
         barmode="stack",
     )
     modbases_fig = go.Figure(data=modbases_data, layout=modbases_layout)
-    plotly.offline.plot(modbases_fig, filename=fname, auto_open=False)
+    write_plot_html(modbases_fig, fname, include_plotlyjs)
 
 
-def plot_mutation_histogram(nuc_pos, num_of_mutations, fname) -> None:
+def plot_mutation_histogram(
+    nuc_pos, num_of_mutations, fname, include_plotlyjs=True
+) -> None:
     mut_hist_data = go.Bar(x=nuc_pos, y=num_of_mutations)
     mut_hist_layout = go.Layout(
         title="Mutations: ",
@@ -436,11 +703,11 @@ def plot_mutation_histogram(nuc_pos, num_of_mutations, fname) -> None:
         yaxis=dict(title="Abundance"),
     )
     mut_hist_fig = go.Figure(data=mut_hist_data, layout=mut_hist_layout)
-    plotly.offline.plot(mut_hist_fig, filename=fname, auto_open=False)
+    write_plot_html(mut_hist_fig, fname, include_plotlyjs)
 
 
 def plot_population_avg(
-    df: pd.DataFrame, name: str, fname: str, plot_sequence=False
+    df: pd.DataFrame, name: str, fname: str, plot_sequence=False, include_plotlyjs=True
 ) -> None:
     colors = colors_for_sequence(df["nuc"])
     mut_trace = go.Bar(
@@ -472,7 +739,7 @@ def plot_population_avg(
             ticktext=["%s<br>%s" % (x, y) for (x, y) in zip(seqs, db)],
             tickangle=0,
         )
-    plotly.offline.plot(mut_fig, filename=fname, auto_open=False)
+    write_plot_html(mut_fig, fname, include_plotlyjs)
     # TODO add options for this maybe move to another function?
     if globals.kaleido_exists:
         file_path = fname[:-5] + ".png"
@@ -495,6 +762,8 @@ def merge_mut_histo_files(mh_files, outdir, kind="pickle") -> None:
     for mh_file in mh_files:
         if kind == "pickle":
             mut_histos.append(get_mut_histos_from_pickle_file(mh_file))
+        elif kind == "npz":
+            mut_histos.append(get_mut_histos_from_npz_file(mh_file))
         else:
             mut_histos.append(get_mut_histos_from_json_file(mh_files))
     merged = merge_all_merge_mut_histo_dicts(mut_histos)
@@ -525,8 +794,40 @@ def merge_all_merge_mut_histo_dicts(
     :param mut_histos: list of mutational histogram dictionaries
     :return: merged mutational histogram dictionary
     """
-    merged = mut_histos.pop(0)
-    for mh in mut_histos:
-        merge_mut_histo_dicts(merged, mh)
-    return merged
+    # merges pairs of dictionaries in rounds, numpy releases the GIL while
+    # adding the arrays so the pairs of a round are merged in parallel
+    mut_histos = list(mut_histos)
+    with ThreadPoolExecutor() as executor:
+        while len(mut_histos) > 1:
+            pairs = zip(mut_histos[::2], mut_histos[1::2])
+            merged = list(executor.map(_merge_mut_histo_dict_pair, pairs))
+            if len(mut_histos) % 2 == 1:
+                merged.append(mut_histos[-1])
+            mut_histos = merged
+    return mut_histos[0]
+
+
+def _merge_mut_histo_dict_pair(pair):
+    left, right = pair
+    merge_mut_histo_dicts(left, right)
+    return left
+
+
+# histogram kernel #############################################################
+
+
+@numba.njit(parallel=True, cache=True)
+def _count_codes(bits, n_codes):
+    """
+    counts how often each code below n_codes occurs at each position of a
+    batch of bit vectors, returns an array indexed by code then position
+    """
+    n_rows, n_cols = bits.shape
+    counts = np.zeros((n_codes, n_cols), dtype=np.int64)
+    for col in numba.prange(n_cols):
+        for row in range(n_rows):
+            code = bits[row, col]
+            if code < n_codes:
+                counts[code, col] += 1
+    return counts
 
@@ -7,6 +7,14 @@ from rna_map import logger
 
 log = logger.get_logger("SAM")
 
+# pysam is optional, sam files are parsed in python when it is not installed
+try:
+    import pysam
+
+    pysam_exists = True
+except ImportError:
+    pysam_exists = False
+
 
 @dataclass(frozen=True, order=True)
 class AlignedRead:
@@ -60,12 +68,61 @@ class SamIterator(object):
         return self._good
 
 
+def open_sam_lines(samfile_path, ref_seqs):
+    """
+    Returns an iterator over the alignment lines of a sam file
+    :param samfile_path: path to the sam file, or a list of sam lines that
+    already has the header removed
+    :param ref_seqs: reference sequences, used to know how many header lines
+    to skip
+    """
+    if isinstance(samfile_path, list):
+        return iter(samfile_path)
+    f = open(samfile_path)
+    ignore_lines = len(ref_seqs.keys()) + 2
+    for line_index in range(ignore_lines):  # Ignore header lines
+        f.readline()
+    return f
+
+
+def read_sam_line_chunks(samfile_path, ref_seqs, chunk_size):
+    """
+    Yields lists of alignment lines from a sam file, stops at the first
+    blank line like the sam iterators do
+    :param samfile_path: path to the sam file, bam and cram files are read
+    with pysam
+    :param ref_seqs: reference sequences
+    :param chunk_size: max number of lines per chunk, keep this even for
+    paired reads so mates stay in the same chunk
+    """
+    # bam and cram files are binary so their lines come from pysam
+    if (
+        pysam_exists
+        and not isinstance(samfile_path, list)
+        and str(samfile_path).endswith((".bam", ".cram"))
+    ):
+        f = pysam.AlignmentFile(str(samfile_path))
+        lines = (segment.to_string() for segment in f.fetch(until_eof=True))
+    else:
+        f = open_sam_lines(samfile_path, ref_seqs)
+        lines = f
+    chunk = []
+    for line in lines:
+        line = line.strip()
+        if len(line) == 0:
+            break
+        chunk.append(line)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    f.close()
+    if len(chunk) > 0:
+        yield chunk
+
+
 class SingleSamIterator(object):
     def __init__(self, samfile_path, ref_seqs):
-        self._f = open(samfile_path)
-        ignore_lines = len(ref_seqs.keys()) + 2
-        for line_index in range(ignore_lines):  # Ignore header lines
-            self._f.readline()
+        self._f = open_sam_lines(samfile_path, ref_seqs)
         self._read_1_line = ""
         self._read_1 = None
 
@@ -73,7 +130,7 @@ class SingleSamIterator(object):
         return self
 
     def __next__(self):
-        self._read_1_line = self._f.readline().strip()
+        self._read_1_line = next(self._f, "").strip()
         if len(self._read_1_line) == 0:
             raise StopIteration
         self._read_1 = get_aligned_read_from_line(self._read_1_line)
@@ -82,10 +139,7 @@ class SingleSamIterator(object):
 
 class PairedSamIterator(object):
     def __init__(self, samfile_path, ref_seqs):
-        self._f = open(samfile_path)
-        ignore_lines = len(ref_seqs.keys()) + 2
-        for line_index in range(ignore_lines):  # Ignore header lines
-            self._f.readline()
+        self._f = open_sam_lines(samfile_path, ref_seqs)
         self._read_1_line = ""
         self._read_2_line = ""
         self._read_1 = None
@@ -95,8 +149,8 @@ class PairedSamIterator(object):
         return self
 
     def __next__(self):
-        self._read_1_line = self._f.readline().strip()
-        self._read_2_line = self._f.readline().strip()
+        self._read_1_line = next(self._f, "").strip()
+        self._read_2_line = next(self._f, "").strip()
         if len(self._read_1_line) == 0 or len(self._read_2_line) == 0:
             raise StopIteration
         self._read_1 = get_aligned_read_from_line(self._read_1_line)
@@ -123,3 +177,39 @@ class PairedSamIterator(object):
             )
             self.__next__()
         return [self._read_1, self._read_2]
+
+
+class PysamIterator(object):
+    """
+    Iterates over the reads of a sam or bam file with pysam, htslib does the
+    parsing and decompresses bam files with threads. Returns the same lists
+    of AlignedRead objects as SingleSamIterator and PairedSamIterator
+    """
+
+    def __init__(self, samfile_path, paired, threads=1):
+        self._f = pysam.AlignmentFile(str(samfile_path), threads=threads)
+        self._segments = self._f.fetch(until_eof=True)
+        self._paired = paired
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        read_1 = get_aligned_read_from_line(next(self._segments).to_string())
+        if not self._paired:
+            return [read_1]
+        read_2 = get_aligned_read_from_line(next(self._segments).to_string())
+        # check if reads are paired
+        if not (
+            read_1.pnext == read_2.pos
+            and read_1.rname == read_2.rname
+            and read_1.rnext == "="
+            and read_1.qname == read_2.qname
+            and read_1.mapq == read_2.mapq
+        ):
+            log.warning(
+                "mate_2 is inconsistent with mate_1 for read: "
+                f"{read_1.qname} SKIPPING!"
+            )
+            return self.__next__()
+        return [read_1, read_2]
@@ -1,7 +1,10 @@
+import functools
 import os
 import shutil
 from pathlib import Path
 
+import numpy as np
+
 
 def fasta_to_dict(fasta_file):
     """
@@ -34,6 +37,21 @@ def parse_phred_qscore_file(qscore_filename):
     return phred_qscore
 
 
+@functools.lru_cache(maxsize=None)
+def parse_phred_qscore_lut(qscore_filename):
+    """
+    Parse the phred qscore file into a lookup table indexed by ascii value.
+    The table is cached per file and shared between callers so it must not
+    be modified
+    :param qscore_filename: path to the phred qscore file
+    :return: np.uint8 array of length 256, symbols not in the file score 0
+    """
+    phred_lut = np.zeros(256, dtype=np.uint8)
+    for symbol, score in parse_phred_qscore_file(qscore_filename).items():
+        phred_lut[ord(symbol)] = score
+    return phred_lut
+
+
 def get_filename(path):
     """
     get the filename from a path
@@ -1,13 +1,21 @@
 """
 test bit_vector module
 """
+
 import os
 import shutil
 import pytest
+import numpy as np
 from pathlib import Path
 from rna_map.util import fasta_to_dict
 from rna_map.parameters import get_default_params
+from rna_map import bit_vector
 from rna_map.bit_vector import BitVectorIterator, BitVectorGenerator
+from rna_map.mutation_histogram import (
+    MutationHistogram,
+    get_mut_histos_from_npz_file,
+)
+from rna_map.sam import pysam_exists
 
 TEST_DIR = os.path.dirname(os.path.realpath(__file__))
 
@@ -29,13 +37,64 @@ def test_bit_vector_iterator():
     )
     bit_vector_iter = BitVectorIterator(sam_path, ref_seqs, False)
     bit_vector = next(bit_vector_iter)
-    assert len(bit_vector.data) == 146
+    # one slot per reference position plus the unused 0 index
+    assert len(bit_vector.data) == 135
+    # 134M12S, the soft clipped tail runs past the end of the reference
+    assert np.count_nonzero(bit_vector.data) == 134
     count = 0
     for _ in bit_vector_iter:
         count += 1
     assert count == 2356
 
 
+@pytest.mark.quick
+def test_bit_vector_iterator_rejects_low_mapq():
+    """
+    test reads under the mapping score cutoff are returned without bit vectors
+    """
+    fa_path = Path(TEST_DIR) / "resources" / "case_1" / "test.fasta"
+    ref_seqs = fasta_to_dict(fa_path)
+    sam_path = (
+        Path(TEST_DIR)
+        / "resources"
+        / "case_1"
+        / "output"
+        / "Mapping_Files"
+        / "aligned.sam"
+    )
+    bit_vector_iter = BitVectorIterator(sam_path, ref_seqs, False, map_score_cutoff=15)
+    rejected = [bv for bv in bit_vector_iter if bv.reject_reason is not None]
+    assert len(rejected) == 1
+    assert rejected[0].reject_reason == "low_mapq"
+    assert rejected[0].data is None
+    assert bit_vector_iter.rejected == 1
+
+
+@pytest.mark.quick
+def test_bit_vector_iterator_rejects_cigar_longer_than_read():
+    """
+    test a cigar string that consumes more bases than its read does not read
+    into the next read of the batch
+    """
+    ref_seqs = {"ref": "A" * 20}
+    lines = [
+        "read_1\t0\tref\t1\t44\t20M\t*\t0\t0\t"
+        + "A" * 10
+        + "\t"
+        + "F" * 10
+        + "\tMD:Z:10",
+        "read_2\t0\tref\t1\t44\t10M\t*\t0\t0\t"
+        + "T" * 10
+        + "\t"
+        + "F" * 10
+        + "\tMD:Z:10",
+    ]
+    bit_vectors = list(BitVectorIterator(lines, ref_seqs, False))
+    assert np.count_nonzero(bit_vectors[0].data) == 0
+    assert bit_vectors[0].n_mutations == 0
+    assert bit_vectors[1].n_mutations == 10
+
+
 @pytest.mark.quick
 def test_bit_vector_generator():
     """
@@ -56,3 +115,114 @@ def test_bit_vector_generator():
     bv_gen.run(sam_path, fa_path, False, Path(""))
     assert os.path.exists(Path("output/BitVector_Files/summary.csv"))
     shutil.rmtree("output")
+
+
+@pytest.mark.quick
+def test_bit_vector_generator_many_references(tmp_path, monkeypatch):
+    """
+    test bit vectors queued for the mutation histograms stay bounded when
+    reads are spread over many references
+    """
+    batch_size = 20
+    n_refs, n_reads = 50, 10
+    monkeypatch.setattr(bit_vector, "BATCH_SIZE", batch_size)
+    counts = {"yielded": 0, "recorded": 0}
+    iterator_next = BitVectorIterator.__next__
+    record_bit_vectors = MutationHistogram.record_bit_vectors
+
+    def counting_next(self):
+        bv = iterator_next(self)
+        counts["yielded"] += 1
+        assert counts["yielded"] - counts["recorded"] <= batch_size
+        return bv
+
+    def counting_record(self, bit_vectors, n_mutations, encoding):
+        counts["recorded"] += len(bit_vectors)
+        record_bit_vectors(self, bit_vectors, n_mutations, encoding)
+
+    monkeypatch.setattr(BitVectorIterator, "__next__", counting_next)
+    monkeypatch.setattr(MutationHistogram, "record_bit_vectors", counting_record)
+    seq = "ACGT" * 5
+    fa_path = tmp_path / "test.fasta"
+    sam_path = tmp_path / "aligned.sam"
+    with open(fa_path, "w") as f:
+        for i in range(n_refs):
+            f.write(f">ref_{i}\n{seq}\n")
+    with open(sam_path, "w") as f:
+        f.write("@HD\tVN:1.5\tSO:unsorted\n")
+        for i in range(n_refs):
+            f.write(f"@SQ\tSN:ref_{i}\tLN:{len(seq)}\n")
+        f.write("@PG\tID:bowtie2\n")
+        for j in range(n_reads):
+            for i in range(n_refs):
+                f.write(
+                    f"read_{i}_{j}\t0\tref_{i}\t1\t44\t20M\t*\t0\t0\t{seq}\t"
+                    f"{'F' * len(seq)}\tMD:Z:20\n"
+                )
+    params = get_default_params()
+    params["dirs"]["output"] = str(tmp_path / "output")
+    params["bit_vector"]["summary_output_only"] = True
+    params["bit_vector"]["no_plots"] = True
+    bv_gen = BitVectorGenerator()
+    bv_gen.setup(params)
+    bv_gen.run(sam_path, fa_path, False, Path(""))
+    assert counts["recorded"] == n_refs * n_reads
+    mut_histos = get_mut_histos_from_npz_file(
+        tmp_path / "output" / "BitVector_Files" / "mutation_histos.npz"
+    )
+    assert len(mut_histos) == n_refs
+    for mh in mut_histos.values():
+        assert mh.num_aligned == n_reads
+
+
+@pytest.mark.quick
+def test_bit_vector_generator_parallel():
+    """
+    test bit vector generation with worker processes matches a single process
+    """
+    fa_path = Path(TEST_DIR) / "resources" / "case_1" / "test.fasta"
+    sam_path = Path(TEST_DIR) / "resources" / "aligned.sam"
+    outputs = []
+    for nthreads in [1, 2]:
+        params = get_default_params()
+        params["dirs"]["output"] = f"output_{nthreads}"
+        params["bit_vector"]["nthreads"] = nthreads
+        bv_gen = BitVectorGenerator()
+        bv_gen.setup(params)
+        bv_gen.run(sam_path, fa_path, True, Path(""))
+        bv_dir = Path(f"output_{nthreads}/BitVector_Files")
+        with open(bv_dir / "mttr-6-alt-h3_bitvectors.txt") as f:
+            bit_vectors = f.read()
+        with open(bv_dir / "summary.csv") as f:
+            summary = f.read()
+        outputs.append((bit_vectors, summary))
+        shutil.rmtree(f"output_{nthreads}")
+    assert outputs[0] == outputs[1]
+
+
+@pytest.mark.skipif(not pysam_exists, reason="pysam is not installed")
+def test_bit_vector_generator_parallel_bam(tmp_path):
+    """
+    test worker processes can read bam files
+    """
+    import pysam
+
+    fa_path = Path(TEST_DIR) / "resources" / "case_1" / "test.fasta"
+    sam_path = Path(TEST_DIR) / "resources" / "aligned.sam"
+    bam_path = tmp_path / "aligned.bam"
+    pysam.view("-b", "-o", str(bam_path), str(sam_path), catch_stdout=False)
+    outputs = []
+    for nthreads, path in [(1, sam_path), (2, bam_path)]:
+        params = get_default_params()
+        params["dirs"]["output"] = str(tmp_path / f"output_{nthreads}")
+        params["bit_vector"]["nthreads"] = nthreads
+        bv_gen = BitVectorGenerator()
+        bv_gen.setup(params)
+        bv_gen.run(path, fa_path, True, Path(""))
+        bv_dir = tmp_path / f"output_{nthreads}" / "BitVector_Files"
+        with open(bv_dir / "mttr-6-alt-h3_bitvectors.txt") as f:
+            bit_vectors = f.read()
+        with open(bv_dir / "summary.csv") as f:
+            summary = f.read()
+        outputs.append((bit_vectors, summary))
+    assert outputs[0] == outputs[1]
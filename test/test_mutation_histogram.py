@@ -1,16 +1,24 @@
 """
 test mutational histogram
 """
+
 import os
 import pickle
 import json
+import numpy as np
 import pytest
 from pathlib import Path
 
+from rna_map import mutation_histogram
 from rna_map.mutation_histogram import (
+    BitVectorEncoding,
     MutationHistogram,
+    ijson_exists,
     get_dataframe,
     get_mut_histos_from_json_file,
+    write_mut_histos_to_json_file,
+    get_mut_histos_from_npz_file,
+    write_mut_histos_to_npz_file,
     plot_read_coverage,
     plot_modified_bases,
     plot_mutation_histogram,
@@ -42,6 +50,22 @@ def test_mutation_histogram():
     assert mh.end == 8
 
 
+def test_record_bit_vectors():
+    mh = MutationHistogram("construct_1", "ACGT", "DMS")
+    # 0 no data, 1 no mutation, 2 deletion, 3 ambiguous, 5-8 A/C/G/T
+    bit_vectors = np.array([[0, 1, 5, 2, 3], [0, 0, 1, 8, 6]], dtype=np.uint8)
+    encoding = BitVectorEncoding.from_codes({"A": 5, "C": 6, "G": 7, "T": 8}, 2, 3)
+    mh.record_bit_vectors(bit_vectors, np.array([1, 2]), encoding)
+    assert mh.num_reads == 2
+    assert list(mh.info_bases) == [0, 1, 2, 2, 2]
+    assert list(mh.cov_bases) == [0, 1, 2, 2, 1]
+    assert list(mh.mut_bases) == [0, 0, 1, 1, 1]
+    assert list(mh.del_bases) == [0, 0, 0, 1, 0]
+    assert list(mh.mod_bases["A"]) == [0, 0, 1, 0, 0]
+    assert list(mh.mod_bases["T"]) == [0, 0, 0, 1, 0]
+    assert list(mh.num_of_mutations[:3]) == [0, 1, 1]
+
+
 def test_merge():
     """
     test merge
@@ -124,6 +148,25 @@ def test_mutation_histogram_to_json():
     os.remove("test.json")
 
 
+@pytest.mark.skipif(not ijson_exists, reason="ijson is not installed")
+def test_mutation_histogram_from_json_stream(monkeypatch):
+    mh = get_example_mut_histo()
+    write_mut_histos_to_json_file({mh.name: mh}, "test.json")
+    expected = get_mut_histos_from_json_file("test.json")
+    monkeypatch.setattr(mutation_histogram, "JSON_STREAM_SIZE", 0)
+    mhs = get_mut_histos_from_json_file("test.json")
+    os.remove("test.json")
+    assert mhs[mh.name].get_dict() == expected[mh.name].get_dict()
+
+
+def test_mutation_histogram_to_npz():
+    mh = get_example_mut_histo()
+    write_mut_histos_to_npz_file({mh.name: mh}, "test.npz")
+    mhs = get_mut_histos_from_npz_file("test.npz")
+    assert mhs[mh.name].get_dict() == mh.get_dict()
+    os.remove("test.npz")
+
+
 def test_plot_read_coverage():
     """
     test plot_read_coverage
@@ -3,7 +3,10 @@ test sam module
 """
 import os
 from pathlib import Path
-from rna_map.sam import SingleSamIterator
+
+import pytest
+
+from rna_map.sam import SingleSamIterator, PysamIterator, pysam_exists
 from rna_map.util import fasta_to_dict
 
 TEST_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -31,3 +34,20 @@ def test_single_sam_iterator():
     assert read.rnext == "*"
     assert read.pnext == 0
     assert read.tlen == 0
+
+
+@pytest.mark.skipif(not pysam_exists, reason="pysam is not installed")
+def test_pysam_iterator_matches_sam_iterator():
+    fa_path = Path(TEST_DIR) / "resources" / "case_1" / "test.fasta"
+    ref_seqs = fasta_to_dict(fa_path)
+    sam_path = os.path.join(
+        TEST_DIR,
+        "resources",
+        "case_1",
+        "output",
+        "Mapping_Files",
+        "aligned.sam",
+    )
+    reads = list(SingleSamIterator(sam_path, ref_seqs))
+    pysam_reads = list(PysamIterator(sam_path, False))
+    assert reads == pysam_reads